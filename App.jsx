@@ -50,6 +50,13 @@ export default function App() {
 
     socketRef.current.on('connect', () => {
       setConnectionStatus('connected')
+      if (userId) {
+        socketRef.current.emit('register_user', {
+          user_id: userId,
+          username: username.trim(),
+          elo_rating: 1000,
+        })
+      }
     })
 
     socketRef.current.on('disconnect', () => {
@@ -77,9 +84,10 @@ export default function App() {
     })
 
     socketRef.current.on('match_found', (data) => {
+      const opponent = data.players.find((p) => p.socket_id !== socketRef.current.id)
       setRoomId(data.room_id)
       setChallenge(data.challenge)
-      setOpponent(data.opponent)
+      setOpponent(opponent)
       setInQueue(false)
       setInBattle(true)
       setUserCode('')
@@ -88,7 +96,7 @@ export default function App() {
       setOpponentTestsPassed(0)
       setTotalTests(data.challenge.test_count)
       setBattleResult(null)
-      addNotification(`Match found! Facing ${data.opponent.username}`)
+      addNotification(`Match found! Facing ${opponent.username}`)
     })
 
     socketRef.current.on('code_submission', (data) => {
@@ -107,6 +115,14 @@ export default function App() {
       }
     })
 
+    socketRef.current.on('test_progress', (data) => {
+      if (data.user_id === userId) {
+        setUserTestsPassed(data.passed_tests)
+      } else {
+        setOpponentTestsPassed(data.passed_tests)
+      }
+    })
+
     socketRef.current.on('opponent_code_update', (data) => {
       setOpponentCode(data.code)
     })
@@ -6,15 +6,28 @@ Handles user connections, matchmaking, code submissions, and real-time updates.
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 import socketio
 from contextlib import asynccontextmanager
 import asyncio
-from typing import Optional, Dict, Set
+import inspect
+from functools import partial
+from typing import Optional, Dict, Set, Tuple
 import json
+import os
 from datetime import datetime
 import logging
 
+try:
+    import msgspec
+except ImportError:  # Optional: falls back to the stdlib json encoder
+    msgspec = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Optional: finished rooms are then dropped without an archive
+    aioredis = None
+
 # Import local modules
 import sys
 from pathlib import Path
@@ -22,20 +35,46 @@ from pathlib import Path
 backend_src = Path(__file__).parent.parent
 sys.path.insert(0, str(backend_src))
 
-from challenges.puzzle_library import get_challenge, CHALLENGES
+from challenges.puzzle_library import (
+    get_challenge_dict, get_test_spec, get_all_challenges_json,
+    get_challenges_by_difficulty_json, get_all_challenges, check_reference_solution,
+)
 from services.matchmaking import matchmaking_system, BattleStatus
-from sandbox.sandbox_runner import execute_code
+from sandbox.sandbox_runner import execute_code_async
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class MsgspecJSON:
+    """
+    json-module stand-in for python-socketio's packet encoder.
+    Every emit payload (progress updates, opponent code) is encoded by
+    msgspec's C encoder; decoding client packets stays on the stdlib.
+    """
+    _encoder = msgspec.json.Encoder() if msgspec is not None else None
+    
+    @classmethod
+    def dumps(cls, obj, **kwargs) -> str:
+        return cls._encoder.encode(obj).decode()
+    
+    loads = staticmethod(json.loads)
+
+
+class MsgspecResponse(JSONResponse):
+    """Default REST response class; renders the body with the same msgspec encoder."""
+    
+    def render(self, content) -> bytes:
+        return MsgspecJSON._encoder.encode(content)
+
+
 # Configure Socket.io
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins=[],
     ping_timeout=60,
     ping_interval=25,
+    json=MsgspecJSON if msgspec is not None else None,
 )
 
 # Track connected users: {user_id: {socket_id, username, elo}}
@@ -44,12 +83,49 @@ connected_users: Dict[str, dict] = {}
 # Track socket to user mapping: {socket_id: user_id}
 socket_to_user: Dict[str, str] = {}
 
+# Window (seconds) in which sync_code keystrokes are coalesced into one update
+SYNC_CODE_DEBOUNCE = 0.05
+
+# Latest unsent sync_code payload per (room_id, sender sid)
+pending_code_syncs: Dict[Tuple[str, str], dict] = {}
+background_tasks: Set[asyncio.Task] = set()  # Keeps flush tasks referenced until done
+
+# Finished rooms are evicted from memory; with REDIS_URL set they stay
+# readable from Redis for ROOM_ARCHIVE_TTL seconds
+ROOM_ARCHIVE_TTL = 600
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = aioredis.from_url(REDIS_URL) if aioredis is not None and REDIS_URL else None
+
+# Seconds a player who dropped out of a battle has to reconnect before forfeiting it
+RECONNECT_GRACE = 10
+pending_forfeits: Dict[str, asyncio.Task] = {}  # user_id -> forfeit timer
+
+# Wall-clock ISO timestamp shared by all handlers, refreshed every CLOCK_RESOLUTION seconds
+CLOCK_RESOLUTION = 0.1
+current_timestamp = datetime.utcnow().isoformat()
+
+
+async def refresh_clock():
+    """Keep current_timestamp fresh so handlers do not format a datetime per event."""
+    global current_timestamp
+    while True:
+        await asyncio.sleep(CLOCK_RESOLUTION)
+        current_timestamp = datetime.utcnow().isoformat()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup/shutdown events."""
     logger.info("Python-Duel server started")
+    # Catch expected outputs that drifted from their reference solutions
+    for challenge_id in get_all_challenges():
+        if not check_reference_solution(challenge_id):
+            logger.error(f"Test cases for {challenge_id} disagree with the reference solution")
+    clock_task = asyncio.create_task(refresh_clock())
     yield
+    clock_task.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
     logger.info("Python-Duel server shutting down")
 
 
@@ -58,7 +134,8 @@ app = FastAPI(
     title="Python-Duel",
     description="Real-time 1v1 competitive Python coding platform",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MsgspecResponse if msgspec is not None else JSONResponse,
 )
 
 # Add CORS middleware FIRST (middleware order matters - first added = last executed)
@@ -102,6 +179,11 @@ async def disconnect(sid):
         # Remove from queue if waiting
         matchmaking_system.remove_from_queue(user_id)
         
+        # Leave a dropped player's battle open for RECONNECT_GRACE seconds
+        battle_room = matchmaking_system.get_player_battle_room(user_id)
+        if battle_room is not None and user_id not in pending_forfeits:
+            pending_forfeits[user_id] = asyncio.create_task(forfeit_after_grace(user_id, battle_room.room_id))
+        
         # Remove from connected users
         if user_id in connected_users:
             del connected_users[user_id]
@@ -141,9 +223,10 @@ async def register_user(sid, data):
             'socket_id': sid,
             'username': username,
             'elo_rating': elo_rating,
-            'connected_at': datetime.utcnow().isoformat()
+            'connected_at': current_timestamp
         }
         socket_to_user[sid] = user_id
+        await rejoin_battle(user_id, sid)
         
         logger.info(f"User registered successfully: {user_id} ({username}) on socket {sid} - Total users: {len(connected_users)}")
         logger.debug(f"Connected users: {list(connected_users.keys())}")
@@ -181,7 +264,7 @@ async def join_queue(sid, data):
                 'socket_id': sid,
                 'username': username or 'Anonymous',
                 'elo_rating': elo_rating,
-                'connected_at': datetime.utcnow().isoformat()
+                'connected_at': current_timestamp
             }
             socket_to_user[sid] = user_id
             logger.info(f"Auto-registered user: {user_id} ({username})")
@@ -193,13 +276,14 @@ async def join_queue(sid, data):
             user_id=user_id,
             username=user_info['username'],
             elo_rating=user_info['elo_rating'],
-            socket_id=sid
+            socket_id=sid,
+            challenge_id=challenge_id
         )
         
         await sio.emit('queue_joined', {
             'user_id': user_id,
-            'queue_position': matchmaking_system.queue.index(player) + 1,
-            'queue_size': matchmaking_system.get_queue_size(),
+            'queue_position': matchmaking_system.get_queue_position(player.user_id),
+            'queue_size': matchmaking_system.get_queue_size(player.challenge_id),
             'message': 'Joined matchmaking queue'
         }, to=sid)
         
@@ -236,6 +320,13 @@ async def leave_queue(sid, data):
         await sio.emit('error', {'message': str(e)}, to=sid)
 
 
+async def enter_room(sid: str, room: str):
+    """Add a socket to a room; enter_room is a coroutine in newer python-socketio."""
+    result = sio.enter_room(sid, room)
+    if inspect.isawaitable(result):
+        await result
+
+
 async def attempt_matchmaking(challenge_id: str):
     """Attempt to create matches from the queue."""
     while matchmaking_system.get_queue_size() >= 2:
@@ -247,40 +338,23 @@ async def attempt_matchmaking(challenge_id: str):
         # Start the battle
         matchmaking_system.start_battle(battle_room.room_id)
         
-        # Get challenge details
-        challenge = get_challenge(challenge_id)
+        p1 = battle_room.player1
+        p2 = battle_room.player2
+        
+        # Both sockets join the battle's room, which submit_code and
+        # sync_code broadcast to; each client finds its opponent in 'players'
+        await enter_room(p1.socket_id, battle_room.room_id)
+        await enter_room(p2.socket_id, battle_room.room_id)
         
-        # Notify both players
-        room_data = {
+        await sio.emit('match_found', {
             'room_id': battle_room.room_id,
-            'opponent': None,
-            'challenge': {
-                'id': challenge.id,
-                'name': challenge.name,
-                'description': challenge.description,
-                'difficulty': challenge.difficulty,
-                'time_limit': challenge.time_limit,
-                'function_signature': challenge.function_signature,
-                'test_count': len(challenge.test_cases),
-            },
+            'players': [
+                {'socket_id': p.socket_id, 'username': p.username, 'elo_rating': p.elo_rating}
+                for p in (p1, p2)
+            ],
+            'challenge': get_challenge_dict(challenge_id),
             'message': 'Match found! Battle starting in 3 seconds...'
-        }
-        
-        # Emit to player 1
-        p1_data = room_data.copy()
-        p1_data['opponent'] = {
-            'username': battle_room.player2.username,
-            'elo_rating': battle_room.player2.elo_rating
-        }
-        await sio.emit('match_found', p1_data, to=battle_room.player1.socket_id)
-        
-        # Emit to player 2
-        p2_data = room_data.copy()
-        p2_data['opponent'] = {
-            'username': battle_room.player1.username,
-            'elo_rating': battle_room.player1.elo_rating
-        }
-        await sio.emit('match_found', p2_data, to=battle_room.player2.socket_id)
+        }, to=battle_room.room_id)
         
         logger.info(f"Match created: {battle_room.player1.username} vs {battle_room.player2.username} "
                    f"(Room: {battle_room.room_id})")
@@ -310,30 +384,20 @@ async def submit_code(sid, data):
         # Update player code
         matchmaking_system.update_player_code(room_id, user_id, code)
         
-        # Get challenge
-        challenge = get_challenge(battle_room.challenge_id)
-        if not challenge:
+        # Function name and test payload are precomputed per challenge
+        spec = get_test_spec(battle_room.challenge_id)
+        if spec is None:
             await sio.emit('error', {'message': 'Challenge not found'}, to=sid)
             return
+        func_name, test_cases = spec
         
-        # Prepare test cases
-        test_cases = [
-            {
-                'input': tc.input_data if not isinstance(tc.input_data, tuple) else tc.input_data,
-                'expected': tc.expected_output
-            }
-            for tc in challenge.test_cases
-        ]
-        
-        # Extract function name from signature
-        func_signature = challenge.function_signature
-        func_name = func_signature.split('(')[0].replace('def ', '').strip()
+        # Execute code in sandbox; each test result is broadcast as it finishes
+        execution_result = await execute_code_async(code, test_cases, func_name, timeout=5,
+                                                    challenge_id=battle_room.challenge_id,
+                                                    on_progress=partial(emit_test_progress, room_id, user_id))
         
-        # Execute code in sandbox
-        execution_result = execute_code(code, test_cases, func_name, timeout=5)
-        
-        # Update test results
-        matchmaking_system.update_test_results(
+        # Update test results; nothing is recorded once the battle has a winner
+        recorded = matchmaking_system.update_test_results(
             room_id, user_id,
             execution_result.passed_tests,
             execution_result.total_tests
@@ -353,11 +417,10 @@ async def submit_code(sid, data):
         # Broadcast to both players in real-time
         await sio.emit('code_submission', submission_result, to=room_id)
         
-        # Check if battle is complete
-        if execution_result.passed_tests == execution_result.total_tests:
+        # Check if battle is complete; only the submission that won it gets
+        # here, so a second passing submission cannot announce another winner
+        if recorded and execution_result.passed_tests == execution_result.total_tests:
             # Player won!
-            battle_room = matchmaking_system.get_battle_room(room_id)
-            
             winner = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
             loser = battle_room.player2 if user_id == battle_room.player1.user_id else battle_room.player1
             
@@ -370,6 +433,7 @@ async def submit_code(sid, data):
             
             await sio.emit('battle_complete', winner_data, to=room_id)
             logger.info(f"Battle complete: {winner.username} won (Room: {room_id})")
+            await archive_battle_room(room_id)
         
         logger.info(f"Code submission: {user_id} - {execution_result.passed_tests}/{execution_result.total_tests} tests passed")
     
@@ -378,6 +442,89 @@ async def submit_code(sid, data):
         await sio.emit('error', {'message': str(e)}, to=sid)
 
 
+def emit_test_progress(room_id: str, user_id: str, entry: dict):
+    """
+    Broadcast one finished test of a running submission to both players.
+    entry comes from the sandboxed job, so only its known fields are passed on.
+    """
+    task = asyncio.create_task(sio.emit('test_progress', {
+        'test': entry.get('test'),
+        'status': entry.get('status'),
+        'passed_tests': entry.get('passed_tests'),
+        'user_id': user_id,
+        'room_id': room_id,
+    }, to=room_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def archive_battle_room(room_id: str):
+    """Evict a finished or abandoned room from memory, keeping a copy in Redis when configured."""
+    battle_room = matchmaking_system.close_battle_room(room_id)
+    if battle_room is None or redis_client is None:
+        return
+    
+    try:
+        await redis_client.setex(f"room:{room_id}", ROOM_ARCHIVE_TTL, json.dumps(battle_room.to_dict()))
+    except Exception as e:
+        logger.warning(f"Could not archive room {room_id}: {e}")
+
+
+async def forfeit_after_grace(user_id: str, room_id: str):
+    """
+    Close a battle whose player did not reconnect in time. The opponent wins
+    if they are still connected; with both players gone the room is abandoned.
+    """
+    await asyncio.sleep(RECONNECT_GRACE)
+    del pending_forfeits[user_id]
+    
+    battle_room = matchmaking_system.get_battle_room(room_id)
+    if battle_room is None:
+        return  # Someone won while the player was away
+    
+    leaver = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
+    opponent = battle_room.player2 if leaver is battle_room.player1 else battle_room.player1
+    winner = None
+    if opponent.user_id in connected_users:
+        winner = matchmaking_system.forfeit_battle(room_id, user_id)
+    
+    if winner is not None:
+        await sio.emit('battle_complete', {
+            'winner_username': winner.username,
+            'loser_username': leaver.username,
+            'winner_id': winner.user_id,
+            'message': f'{leaver.username} left the battle. {winner.username} wins!'
+        }, to=room_id)
+        logger.info(f"Battle forfeited: {leaver.username} left (Room: {room_id})")
+    elif battle_room.winner_id is None:
+        battle_room.status = BattleStatus.ABANDONED
+    await archive_battle_room(room_id)
+
+
+async def rejoin_battle(user_id: str, sid: str):
+    """Put a user who reconnected within RECONNECT_GRACE back into their battle room."""
+    forfeit = pending_forfeits.pop(user_id, None)
+    if forfeit is None:
+        return
+    forfeit.cancel()
+    
+    battle_room = matchmaking_system.get_player_battle_room(user_id)
+    if battle_room is not None:
+        player = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
+        player.socket_id = sid
+        await enter_room(sid, battle_room.room_id)
+        logger.info(f"User {user_id} rejoined room {battle_room.room_id}")
+
+
+async def flush_code_sync(key: Tuple[str, str]):
+    """After the debounce window, send the latest queued code for (room_id, sid)."""
+    await asyncio.sleep(SYNC_CODE_DEBOUNCE)
+    payload = pending_code_syncs.pop(key, None)
+    if payload is not None:
+        room_id, sid = key
+        await sio.emit('opponent_code_update', payload, to=room_id, skip_sid=sid)
+
+
 @sio.event
 async def sync_code(sid, data):
     """
@@ -396,11 +543,18 @@ async def sync_code(sid, data):
         # Update player code
         matchmaking_system.update_player_code(room_id, user_id, code)
         
-        # Broadcast to opponent (to room, excluding sender)
-        await sio.emit('opponent_code_update', {
+        # Broadcast to opponent (to room, excluding sender), coalescing bursts
+        # of keystrokes into one update per SYNC_CODE_DEBOUNCE window
+        key = (room_id, sid)
+        first_in_window = key not in pending_code_syncs
+        pending_code_syncs[key] = {
             'code': code,
             'user_id': user_id
-        }, to=room_id, skip_sid=sid)
+        }
+        if first_in_window:
+            task = asyncio.create_task(flush_code_sync(key))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
     
     except Exception as e:
         logger.error(f"Error in sync_code: {e}")
@@ -417,43 +571,29 @@ async def root():
         "status": "running",
         "service": "Python-Duel Backend",
         "version": "1.0.0",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": current_timestamp
     }
 
 
 @app.get("/api/challenges")
-async def get_challenges():
-    """Get all available challenges."""
-    challenges = []
-    for challenge_id, challenge in CHALLENGES.items():
-        challenges.append({
-            'id': challenge.id,
-            'name': challenge.name,
-            'description': challenge.description,
-            'difficulty': challenge.difficulty,
-            'time_limit': challenge.time_limit,
-            'test_count': len(challenge.test_cases),
-        })
-    return {"challenges": challenges}
+async def get_challenges(difficulty: Optional[str] = None):
+    """Get all available challenges, optionally filtered by difficulty."""
+    # Listings are serialized once at import; send the bytes as-is
+    if difficulty:
+        body = get_challenges_by_difficulty_json(difficulty)
+    else:
+        body = get_all_challenges_json()
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/challenges/{challenge_id}")
 async def get_challenge_detail(challenge_id: str):
     """Get detailed information about a specific challenge."""
-    challenge = get_challenge(challenge_id)
-    if not challenge:
+    challenge = get_challenge_dict(challenge_id)
+    if challenge is None:
         raise HTTPException(status_code=404, detail="Challenge not found")
     
-    return {
-        'id': challenge.id,
-        'name': challenge.name,
-        'description': challenge.description,
-        'difficulty': challenge.difficulty,
-        'time_limit': challenge.time_limit,
-        'function_signature': challenge.function_signature,
-        'example_code': challenge.example_code,
-        'test_count': len(challenge.test_cases),
-    }
+    return challenge
 
 
 @app.get("/api/queue-info")
@@ -471,6 +611,22 @@ async def get_user_info(user_id: str):
     return connected_users[user_id]
 
 
+@app.get("/api/rooms/{room_id}")
+async def get_archived_room(room_id: str):
+    """Get a finished or abandoned battle room from the Redis archive."""
+    archived = None
+    if redis_client is not None:
+        try:
+            archived = await redis_client.get(f"room:{room_id}")
+        except Exception as e:
+            logger.warning(f"Could not read archived room {room_id}: {e}")
+            raise HTTPException(status_code=503, detail="Room archive unavailable")
+    if archived is None:
+        raise HTTPException(status_code=404, detail="Room not found or not archived")
+    
+    return Response(content=archived, media_type="application/json")
+
+
 @app.get("/api/health")
 async def health_check():
     """Detailed health check."""
@@ -479,7 +635,7 @@ async def health_check():
         "connected_users": len(connected_users),
         "queue_size": matchmaking_system.get_queue_size(),
         "active_battles": len(matchmaking_system.battle_rooms),
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": current_timestamp
     }
 
 
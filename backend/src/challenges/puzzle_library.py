@@ -4,11 +4,13 @@ Each puzzle has test cases that validate solutions.
 """
 
 from dataclasses import dataclass
-from typing import List, Callable, Any
+from functools import lru_cache
+from math import isqrt
+from typing import Dict, List, Callable, Any, Optional, Tuple
 import json
 
 
-@dataclass
+@dataclass(slots=True)
 class TestCase:
     """Represents a single test case for a puzzle."""
     input_data: Any
@@ -16,7 +18,7 @@ class TestCase:
     description: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Challenge:
     """Represents a coding challenge/puzzle."""
     id: str
@@ -305,6 +307,8 @@ def validate_solution(challenge_id: str, user_code: str) -> tuple[bool, dict]:
     challenge = get_challenge(challenge_id)
     if not challenge:
         return False, {"error": "Challenge not found"}
+    if not check_reference_solution(challenge_id):
+        return False, {"error": "Challenge test cases disagree with the reference solution"}
     
     results = {
         "challenge_id": challenge_id,
@@ -317,3 +321,165 @@ def validate_solution(challenge_id: str, user_code: str) -> tuple[bool, dict]:
     # The actual execution happens in the sandbox runner
     # This is just the validation structure
     return False, results
+
+
+# ============================================================================
+# Pre-serialized API payloads (CHALLENGES is read-only after import)
+# ============================================================================
+
+def _challenge_summary(challenge: Challenge) -> dict:
+    """Public listing fields for a challenge; test cases stay server-side."""
+    return {
+        'id': challenge.id,
+        'name': challenge.name,
+        'description': challenge.description,
+        'difficulty': challenge.difficulty,
+        'time_limit': challenge.time_limit,
+        'test_count': len(challenge.test_cases),
+    }
+
+
+def _challenge_detail(challenge: Challenge) -> dict:
+    """Public detail fields for a challenge; test cases stay server-side."""
+    return {
+        'id': challenge.id,
+        'name': challenge.name,
+        'description': challenge.description,
+        'difficulty': challenge.difficulty,
+        'time_limit': challenge.time_limit,
+        'function_signature': challenge.function_signature,
+        'example_code': challenge.example_code,
+        'test_count': len(challenge.test_cases),
+    }
+
+
+def _encode_listing(challenges: List[Challenge]) -> bytes:
+    """Encode a challenge listing the way FastAPI's JSONResponse would."""
+    return json.dumps(
+        {"challenges": [_challenge_summary(c) for c in challenges]},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+ALL_CHALLENGES_JSON: bytes = _encode_listing(list(CHALLENGES.values()))
+
+_CHALLENGES_BY_DIFFICULTY_JSON: Dict[str, bytes] = {
+    difficulty: _encode_listing(get_challenge_by_difficulty(difficulty))
+    for difficulty in {c.difficulty for c in CHALLENGES.values()}
+}
+
+_EMPTY_LISTING_JSON = _encode_listing([])
+
+
+# Shared, read-only detail dicts; callers must not mutate them
+_CHALLENGE_DICT_CACHE: Dict[str, dict] = {
+    cid: _challenge_detail(c) for cid, c in CHALLENGES.items()
+}
+
+
+def get_challenge_dict(challenge_id: str) -> Optional[dict]:
+    """Get the cached public detail dict for a challenge, or None if unknown."""
+    return _CHALLENGE_DICT_CACHE.get(challenge_id)
+
+
+def _function_name(signature: str) -> str:
+    """Pull the function name out of a "def name(...)" signature."""
+    return signature.split('(')[0].removeprefix('def ').strip()
+
+
+# (function_name, test_cases) as the sandbox takes them, keyed by challenge_id
+_TEST_SPEC_CACHE: Dict[str, Tuple[str, List[Dict[str, Any]]]] = {
+    cid: (
+        _function_name(c.function_signature),
+        [{'input': tc.input_data, 'expected': tc.expected_output} for tc in c.test_cases],
+    )
+    for cid, c in CHALLENGES.items()
+}
+
+
+def get_test_spec(challenge_id: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """Get (function_name, test_cases) for running a challenge, or None if unknown."""
+    return _TEST_SPEC_CACHE.get(challenge_id)
+
+
+def get_all_challenges_json() -> bytes:
+    """Get the JSON body listing all challenges."""
+    return ALL_CHALLENGES_JSON
+
+
+def get_challenges_by_difficulty_json(difficulty: str) -> bytes:
+    """Get the JSON body listing challenges of one difficulty."""
+    return _CHALLENGES_BY_DIFFICULTY_JSON.get(difficulty, _EMPTY_LISTING_JSON)
+
+
+# ============================================================================
+# Reference solutions (used to check test cases, never shown to users)
+# ============================================================================
+
+# Primes up to 2**16 are sieved on first use; that covers every 32-bit n
+_SIEVE_LIMIT = 1 << 16
+
+
+def _sieve_primes(limit: int) -> List[int]:
+    """Sieve of Eratosthenes over a bytearray; returns all primes <= limit."""
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[0:2] = b"\x00\x00"
+    for i in range(2, isqrt(limit) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit + 1, i)))
+    return [i for i, is_prime in enumerate(sieve) if is_prime]
+
+
+@lru_cache(maxsize=None)
+def _small_primes() -> List[int]:
+    """The primes up to _SIEVE_LIMIT, so importers that never check a prime skip the sieve."""
+    return _sieve_primes(_SIEVE_LIMIT)
+
+
+def _is_prime_fast(n: int) -> bool:
+    """
+    Reference primality check.
+    Trial-divides by the precomputed primes up to sqrt(n); beyond the sieve
+    it continues on the 2-3 wheel (6k +/- 1), skipping multiples of 2 and 3.
+    """
+    if n < 2:
+        return False
+    
+    for p in _small_primes():
+        if p * p > n:
+            return True
+        if n % p == 0:
+            return n == p
+    
+    # n is larger than the sieve covers; resume at the first 6k - 1 candidate past it
+    i = _SIEVE_LIMIT - _SIEVE_LIMIT % 6 + 5
+    while i * i <= n:
+        if n % i == 0 or n % (i + 2) == 0:
+            return False
+        i += 6
+    return True
+
+
+_REFERENCE_SOLUTIONS: Dict[str, Callable[..., Any]] = {
+    "is_prime": _is_prime_fast,
+}
+
+
+@lru_cache(maxsize=None)
+def check_reference_solution(challenge_id: str) -> bool:
+    """
+    Check a challenge's expected outputs against its reference solution.
+    Returns True when every test case agrees (or no reference exists).
+    Challenges never change after import, so each one is checked once.
+    """
+    challenge = get_challenge(challenge_id)
+    reference = _REFERENCE_SOLUTIONS.get(challenge_id)
+    if not challenge or reference is None:
+        return True
+    
+    for tc in challenge.test_cases:
+        args = tc.input_data if isinstance(tc.input_data, tuple) else (tc.input_data,)
+        if reference(*args) != tc.expected_output:
+            return False
+    return True
@@ -1,20 +1,30 @@
 """
 Secure sandbox runner for executing untrusted Python code.
-Uses subprocess with strict resource limits and import restrictions.
+Uses a pool of warm worker processes with strict resource limits and import restrictions.
 """
 
+import ast
+import asyncio
+import queue
+import re
+import secrets
+import select
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import os
-from typing import Tuple, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple, Dict, Any, List, Optional
 from dataclasses import dataclass
 import json
 import resource
 from pathlib import Path
 
 
-@dataclass
+@dataclass(slots=True)
 class ExecutionResult:
     """Result from code execution."""
     success: bool
@@ -27,61 +37,125 @@ class ExecutionResult:
 
 
 # Forbidden imports that pose security risks
-FORBIDDEN_IMPORTS = {
+FORBIDDEN_IMPORTS = frozenset({
     'os', 'sys', 'subprocess', 'shutil', 'socket', 'requests',
     'urllib', 'http', 'ftplib', 'smtplib', 'ssl', 'pty', 'pwd',
     'grp', 'crypt', '__import__', 'eval', 'exec', 'compile',
     'open', 'input', 'raw_input', 'importlib', 'pkgutil',
     'modulefinder', 'runpy', 'code', 'codeop', 'tracemalloc',
     'asyncio', 'threading', 'multiprocessing', 'concurrent',
-}
+    'io', '_io', 'posix', 'resource', '__main__', 'sandbox', 'sandbox_runner', 'sandbox_worker',
+})
+
+
+# Builtins that run or load arbitrary code when called directly
+FORBIDDEN_CALLS = frozenset({'eval', 'exec', 'compile', '__import__', 'open'})
+
+
+# Names that reach the import machinery or interpreter internals without an
+# import statement, e.g. __import__('os') or ().__class__.__bases__[0].__subclasses__()
+FORBIDDEN_TOKENS = (
+    '__import__', '__builtins__', '__subclasses__', '__globals__',
+    '__bases__', '__mro__', '__code__', '__loader__',
+)
+
+
+# One alternation over all tokens; the regex engine skips ahead on their
+# shared "__" prefix, so a single search beats per-token substring scans
+_FORBIDDEN_TOKEN_RE = re.compile('|'.join(map(re.escape, FORBIDDEN_TOKENS)))
+
+
+def find_forbidden_token(code: str) -> Optional[str]:
+    """Return the first forbidden token in code, scanning it in a single pass."""
+    match = _FORBIDDEN_TOKEN_RE.search(code)
+    return match.group() if match else None
+
+
+class ImportChecker(ast.NodeVisitor):
+    """Collects forbidden imports and calls in a single walk of the syntax tree."""
+    
+    def __init__(self):
+        self.imports = set()
+        self.calls = set()
+    
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            root = alias.name.split('.')[0]
+            if root in FORBIDDEN_IMPORTS:
+                self.imports.add(root)
+    
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        if node.module and node.level == 0:
+            root = node.module.split('.')[0]
+            if root in FORBIDDEN_IMPORTS:
+                self.imports.add(root)
+    
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in FORBIDDEN_CALLS:
+            self.calls.add(node.func.id)
+        self.generic_visit(node)
 
 
 def check_forbidden_imports(code: str) -> Tuple[bool, str]:
     """
-    Check if code attempts to import forbidden modules.
+    Check if code attempts to import forbidden modules or call forbidden builtins.
+    Rejects forbidden tokens first, then parses the code once and walks it
+    with ImportChecker. Code that does not parse is rejected here rather
+    than in a worker.
     Returns (is_safe, error_message)
     """
-    forbidden_found = []
-    
-    for forbidden in FORBIDDEN_IMPORTS:
-        patterns = [
-            f"import {forbidden}",
-            f"from {forbidden}",
-            f"import {forbidden} ",
-            f"from {forbidden} ",
-        ]
-        
-        for pattern in patterns:
-            if pattern in code:
-                forbidden_found.append(forbidden)
-                break
+    token = find_forbidden_token(code)
+    if token is not None:
+        return False, f"Forbidden name detected: {token}"
     
-    if forbidden_found:
-        return False, f"Forbidden imports detected: {', '.join(set(forbidden_found))}"
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return False, f"Syntax error on line {e.lineno}: {e.msg}"
+    
+    checker = ImportChecker()
+    checker.visit(tree)
+    
+    if checker.imports:
+        return False, f"Forbidden imports detected: {', '.join(sorted(checker.imports))}"
+    if checker.calls:
+        return False, f"Forbidden calls detected: {', '.join(sorted(checker.calls))}"
     
     return True, ""
 
 
-def build_test_wrapper(user_code: str, test_cases: List[Dict[str, Any]], 
-                       function_name: str) -> str:
+# Wrapper templates keyed by (challenge_id, function_name). Test cases are static
+# per challenge, so the JSON payload is serialized once and only the user code
+# slot is filled in per submission.
+_WRAPPER_CACHE: Dict[Tuple[str, str], str] = {}
+
+_USER_CODE_SLOT = "{USER_CODE}"
+
+
+def uses_star_args(test_cases: List[Dict[str, Any]]) -> bool:
     """
-    Build a complete test script wrapping the user's code.
-    Injects test execution logic and captures results.
+    Decide the call style once per challenge: tuple inputs are spread across
+    the function's parameters, anything else is passed as a single argument.
+    Must run on the Python-side test cases, since JSON turns tuples into lists.
     """
+    return bool(test_cases) and isinstance(test_cases[0]['input'], tuple)
+
+
+def _build_wrapper_template(test_cases: List[Dict[str, Any]], function_name: str) -> str:
+    """Build the test script with a single placeholder for the user's code."""
+    test_cases_json = json.dumps(test_cases, separators=(',', ':'))
+    call_args = "*input_data" if uses_star_args(test_cases) else "input_data"
     
-    test_cases_json = json.dumps(test_cases)
-    
-    wrapper = f'''
+    return f'''
 import json
 import sys
 import traceback
 
 # User's code
-{user_code}
+{_USER_CODE_SLOT}
 
 # Test execution
-test_cases = {test_cases_json}
+test_cases = json.loads({test_cases_json!r})
 results = []
 passed = 0
 total = len(test_cases)
@@ -92,17 +166,14 @@ for i, test_case in enumerate(test_cases):
         expected = test_case['expected']
         
         # Call user's function
-        if isinstance(input_data, tuple):
-            result = {function_name}(*input_data)
-        else:
-            result = {function_name}(input_data)
+        result = {function_name}({call_args})
         
         # Normalize results for comparison
         if result == expected:
-            results.append({{"test": i+1, "status": "PASS", "expected": str(expected), "got": str(result)}})
+            results.append({{"test": i+1, "status": "PASS"}})
             passed += 1
         else:
-            results.append({{"test": i+1, "status": "FAIL", "expected": str(expected), "got": str(result)}})
+            results.append({{"test": i+1, "status": "FAIL", "expected": repr(expected), "got": repr(result)}})
     
     except Exception as e:
         results.append({{"test": i+1, "status": "ERROR", "error": str(e), "traceback": traceback.format_exc()}})
@@ -116,18 +187,80 @@ output = {{
 
 print(json.dumps(output))
 '''
+
+
+def build_test_wrapper(user_code: str, test_cases: List[Dict[str, Any]], 
+                       function_name: str, challenge_id: Optional[str] = None) -> str:
+    """
+    Build a complete test script wrapping the user's code.
+    Injects test execution logic and captures results.
+    When challenge_id is given the template is cached and reused across submissions.
+    """
+    if challenge_id is None:
+        template = _build_wrapper_template(test_cases, function_name)
+    else:
+        key = (challenge_id, function_name)
+        template = _WRAPPER_CACHE.get(key)
+        if template is None:
+            template = _build_wrapper_template(test_cases, function_name)
+            _WRAPPER_CACHE[key] = template
     
-    return wrapper
+    # The slot precedes the test case literal, so only replace the first match
+    return template.replace(_USER_CODE_SLOT, user_code, 1)
+
+
+# Serialized job headers keyed by (challenge_id, include_tests)
+_JOB_PREFIX_CACHE: Dict[Tuple[str, bool], str] = {}
+
+
+def build_job(user_code: str, test_cases: List[Dict[str, Any]],
+              function_name: str, challenge_id: Optional[str] = None,
+              include_tests: bool = True, progress: bool = False,
+              nonce: str = "") -> bytes:
+    """
+    Encode a worker job as one JSON line.
+    Test cases travel as data next to the user's code instead of being pasted
+    into generated source; everything but the code is serialized once per challenge.
+    Workers keep the test cases of challenges they have seen, so with
+    include_tests=False only the challenge_id is sent. With progress=True the
+    worker also streams a line per finished test. The worker echoes nonce on
+    every line it writes back.
+    """
+    if challenge_id is None:
+        include_tests = True
+        prefix = None
+    else:
+        prefix = _JOB_PREFIX_CACHE.get((challenge_id, include_tests))
+    
+    if prefix is None:
+        prefix = f'{{"fn":{json.dumps(function_name)},"star":{json.dumps(uses_star_args(test_cases))},'
+        if challenge_id is not None:
+            prefix += f'"cid":{json.dumps(challenge_id)},'
+        if include_tests:
+            prefix += f'"tests":{json.dumps(test_cases, separators=(",", ":"))},'
+        prefix += '"code":'
+        if challenge_id is not None:
+            _JOB_PREFIX_CACHE[(challenge_id, include_tests)] = prefix
+    
+    suffix = ',"progress":true' if progress else ''
+    return f'{prefix}{json.dumps(user_code)}{suffix},"nonce":{json.dumps(nonce)}}}\n'.encode()
+
+
+# CPU seconds a single submission may use
+CPU_TIME_LIMIT = 2
+
+# Address space for sandboxed code
+MEMORY_LIMIT_MB = 128
 
 
 def set_resource_limits():
     """Set strict resource limits for the subprocess."""
     try:
-        # Limit CPU time to 2 seconds
-        resource.setrlimit(resource.RLIMIT_CPU, (2, 2))
+        # Limit CPU time to 2 seconds (SIGXCPU, then SIGKILL a second later)
+        resource.setrlimit(resource.RLIMIT_CPU, (CPU_TIME_LIMIT, CPU_TIME_LIMIT + 1))
         
         # Limit memory to 128MB
-        resource.setrlimit(resource.RLIMIT_AS, (128 * 1024 * 1024, 128 * 1024 * 1024))
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_MB * 1024 * 1024, MEMORY_LIMIT_MB * 1024 * 1024))
         
         # Limit file size to 10MB
         resource.setrlimit(resource.RLIMIT_FSIZE, (10 * 1024 * 1024, 10 * 1024 * 1024))
@@ -139,16 +272,193 @@ def set_resource_limits():
         print(f"Warning: Could not set resource limits: {e}", file=sys.stderr)
 
 
+# Number of warm worker processes; 0 runs every submission in a fresh interpreter
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", os.cpu_count() or 1))
+
+# Longest a submission waits for a busy pool before giving up
+ACQUIRE_TIMEOUT = 30
+
+_WORKER_SCRIPT = str(Path(__file__).with_name("sandbox_worker.py"))
+
+
+class SandboxWorker:
+    """A warm Python interpreter that runs jobs sent over its stdin."""
+    
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-P", _WORKER_SCRIPT],  # -P: keep this package off the worker's sys.path
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=tempfile.gettempdir(),
+            start_new_session=True,  # Lets kill() reach the forked job too
+            env={
+                'PYTHONHASHSEED': '0',  # Deterministic hash for consistency
+                # The worker imports nothing from this package, so it gets its limits here
+                'SANDBOX_CPU_TIME_LIMIT': str(CPU_TIME_LIMIT),
+                'SANDBOX_MEMORY_LIMIT_MB': str(MEMORY_LIMIT_MB),
+            }
+        )
+        self._buffer = bytearray()
+        self.challenges: set = set()  # challenge_ids whose tests this worker holds
+    
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
+    
+    def run(self, job: bytes, nonce: str, timeout: float,
+            on_progress: Optional[Callable[[dict], None]] = None) -> Tuple[str, str, Optional[dict]]:
+        """
+        Run one job and return its (stdout, stderr, results).
+        Per-test progress lines that arrive first are passed to on_progress.
+        Every line must echo the job's nonce.
+        """
+        self.proc.stdin.write(job)
+        self.proc.stdin.flush()
+        
+        deadline = time.monotonic() + timeout
+        while True:
+            reply = json.loads(self._read_line(deadline, timeout))
+            if reply.get("nonce") != nonce:
+                # Stale or forged line; the caller kills this worker
+                raise RuntimeError("Sandbox worker reply does not match the job")
+            if "progress" not in reply:
+                break
+            if on_progress is not None:
+                on_progress(reply["progress"])
+        
+        if reply.get("timeout"):
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        return reply["stdout"], reply["stderr"], reply["result"]
+    
+    def _read_line(self, deadline: float, timeout: float) -> bytes:
+        fd = self.proc.stdout.fileno()
+        
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise subprocess.TimeoutExpired(self.proc.args, timeout)
+            
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.proc.wait()  # Worker died mid-job
+                raise RuntimeError(f"Sandbox worker exited with code {self.proc.returncode}")
+            self._buffer += chunk
+        
+        end = self._buffer.index(b"\n")
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        return line
+    
+    def kill(self):
+        if self.is_alive():
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+
+
+class SandboxPool:
+    """
+    Fixed-size pool of warm sandbox workers.
+    Workers are started on demand; a worker that times out or crashes is
+    killed and replaced by a fresh one the next time it is handed out.
+    """
+    
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: "queue.Queue[SandboxWorker]" = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+    
+    def _spawn(self) -> SandboxWorker:
+        """Start a worker in a slot already counted in _started, giving the slot back on failure."""
+        try:
+            return SandboxWorker()
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+    
+    def _acquire(self) -> SandboxWorker:
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                spawn = self._started < self.size
+                if spawn:
+                    self._started += 1
+            if spawn:
+                return self._spawn()
+            try:
+                worker = self._idle.get(timeout=ACQUIRE_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError("No sandbox worker became available") from None
+        
+        if not worker.is_alive():
+            worker.kill()
+            worker = self._spawn()
+        return worker
+    
+    def run(self, user_code: str, test_cases: List[Dict[str, Any]], function_name: str,
+            challenge_id: Optional[str], timeout: float,
+            on_progress: Optional[Callable[[dict], None]] = None) -> Tuple[str, str, Optional[dict]]:
+        """Run a submission on an idle worker and return its (stdout, stderr, results)."""
+        worker = self._acquire()
+        try:
+            # Test cases are only sent the first time this worker sees the challenge
+            include_tests = challenge_id not in worker.challenges
+            nonce = secrets.token_hex(8)
+            job = build_job(user_code, test_cases, function_name, challenge_id, include_tests,
+                            progress=on_progress is not None, nonce=nonce)
+            reply = worker.run(job, nonce, timeout, on_progress)
+            if challenge_id is not None:
+                worker.challenges.add(challenge_id)
+            return reply
+        except BaseException:
+            # The worker is in an unknown state; it is respawned on next acquire
+            worker.kill()
+            raise
+        finally:
+            self._idle.put(worker)
+
+
+_worker_pool = SandboxPool(SANDBOX_WORKERS) if SANDBOX_WORKERS > 0 else None
+
+# Threads that wait on sandbox replies so several submissions run at once
+_executor = ThreadPoolExecutor(max_workers=max(SANDBOX_WORKERS, 1), thread_name_prefix="sandbox")
+
+
+def _run_in_subprocess(test_script: str, timeout: float) -> Tuple[bytes, bytes]:
+    """Run a test script in a fresh interpreter and return its raw (stdout, stderr)."""
+    # "-" makes the interpreter read the whole script from stdin before running
+    # it, so no temp file is written; input() in user code then just sees EOF
+    proc = subprocess.run(
+        [sys.executable, "-"],
+        input=test_script.encode(),
+        capture_output=True,
+        timeout=timeout,
+        cwd=tempfile.gettempdir(),
+        env={'PYTHONHASHSEED': '0'},  # Deterministic hash for consistency
+        preexec_fn=set_resource_limits
+    )
+    if proc.returncode == -signal.SIGXCPU:
+        raise subprocess.TimeoutExpired(proc.args, timeout)  # Hit the CPU limit
+    return proc.stdout, proc.stderr
+
+
 def execute_code(user_code: str, test_cases: List[Dict[str, Any]], 
-                 function_name: str, timeout: int = 5) -> ExecutionResult:
+                 function_name: str, timeout: int = 5,
+                 challenge_id: Optional[str] = None,
+                 on_progress: Optional[Callable[[dict], None]] = None) -> ExecutionResult:
     """
-    Execute user code in a sandboxed subprocess.
+    Execute user code in a sandboxed worker process.
     
     Args:
         user_code: The user's Python code as a string
         test_cases: List of test case dicts with 'input' and 'expected' keys
         function_name: Name of the function to test
         timeout: Maximum execution time in seconds
+        challenge_id: Optional challenge ID used to cache the test wrapper
+        on_progress: Optional callback for each test result as it finishes,
+            with a running passed_tests count (worker pool only)
     
     Returns:
         ExecutionResult with test execution details
@@ -182,61 +492,55 @@ def execute_code(user_code: str, test_cases: List[Dict[str, Any]],
             execution_time=0.0
         )
     
-    # Build the test wrapper script
-    test_script = build_test_wrapper(user_code, test_cases, function_name)
-    
     try:
-        # Create temporary file for the script
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write(test_script)
-            temp_file = f.name
-        
-        try:
-            # Execute in subprocess with timeout
-            proc = subprocess.run(
-                [sys.executable, temp_file],
-                capture_output=True,
-                timeout=timeout,
-                text=True,
-                cwd=tempfile.gettempdir(),
-                env={'PYTHONHASHSEED': '0'}  # Deterministic hash for consistency
+        if _worker_pool is not None:
+            output, error, result_json = _worker_pool.run(
+                user_code, test_cases, function_name, challenge_id, timeout, on_progress
             )
+        else:
+            # Build the test wrapper script
+            test_script = build_test_wrapper(user_code, test_cases, function_name, challenge_id)
+            stdout, stderr = _run_in_subprocess(test_script, timeout)
             
-            output = proc.stdout.strip()
-            error = proc.stderr.strip()
-            
-            # Parse JSON results
+            # The results are the last stdout line; anything before it is the
+            # user's own prints. json.loads takes the bytes directly, so only
+            # the parts shown to the user are ever decoded.
+            prints, _, last_line = stdout.rstrip().rpartition(b"\n")
             try:
-                result_json = json.loads(output)
-                return ExecutionResult(
-                    success=True,
-                    passed_tests=result_json.get('passed', 0),
-                    total_tests=result_json.get('total', len(test_cases)),
-                    test_results=result_json.get('test_results', []),
-                    output=output,
-                    error=error,
-                    execution_time=0.0  # Would need timeit for precise measurement
-                )
-            except json.JSONDecodeError:
-                # Log the actual error for debugging
-                full_error = error if error else f"No JSON output. stdout: {output}"
-                print(f"DEBUG: Code execution failed. stderr: {error}, stdout: {output}", file=sys.stderr)
-                return ExecutionResult(
-                    success=False,
-                    passed_tests=0,
-                    total_tests=len(test_cases),
-                    test_results=[],
-                    output=output,
-                    error=f"Code execution error: {full_error}",
-                    execution_time=0.0
-                )
+                result_json = json.loads(last_line)
+            except ValueError:
+                result_json = None
+                prints = stdout
+            
+            output = prints.decode(errors="replace")
+            error = stderr.decode(errors="replace")
         
-        finally:
-            # Cleanup temp file
-            try:
-                os.unlink(temp_file)
-            except:
-                pass
+        output = output.strip()
+        error = error.strip()
+        
+        if result_json is None:
+            # Log the actual error for debugging
+            full_error = error if error else f"No JSON output. stdout: {output}"
+            print(f"DEBUG: Code execution failed. stderr: {error}, stdout: {output}", file=sys.stderr)
+            return ExecutionResult(
+                success=False,
+                passed_tests=0,
+                total_tests=len(test_cases),
+                test_results=[],
+                output=output,
+                error=f"Code execution error: {full_error}",
+                execution_time=0.0
+            )
+        
+        return ExecutionResult(
+            success=True,
+            passed_tests=result_json.get('passed', 0),
+            total_tests=result_json.get('total', len(test_cases)),
+            test_results=result_json.get('test_results', []),
+            output=output,
+            error=error,
+            execution_time=0.0  # Would need timeit for precise measurement
+        )
     
     except subprocess.TimeoutExpired:
         return ExecutionResult(
@@ -262,16 +566,35 @@ def execute_code(user_code: str, test_cases: List[Dict[str, Any]],
 
 
 def execute_safe_code(user_code: str, test_cases: List[Dict[str, Any]], 
-                      function_name: str) -> ExecutionResult:
+                      function_name: str,
+                      challenge_id: Optional[str] = None) -> ExecutionResult:
     """
     Execute code with Docker container for maximum isolation (if available).
-    Falls back to subprocess if Docker is not available.
+    Falls back to the worker pool if Docker is not available.
+    """
+    # For now, use the worker pool. Docker implementation would wrap this call.
+    return execute_code(user_code, test_cases, function_name, challenge_id=challenge_id)
+
+
+async def execute_code_async(user_code: str, test_cases: List[Dict[str, Any]],
+                             function_name: str, timeout: int = 5,
+                             challenge_id: Optional[str] = None,
+                             on_progress: Optional[Callable[[dict], None]] = None) -> ExecutionResult:
+    """
+    Awaitable execute_code for the server's event loop.
+    The blocking wait on a sandbox worker happens on the sandbox executor,
+    so other battles keep being served while a submission runs.
+    on_progress is called on the event loop, not the executor thread.
     """
-    # For now, use subprocess. Docker implementation would wrap this call.
-    return execute_code(user_code, test_cases, function_name)
+    loop = asyncio.get_running_loop()
+    report = None
+    if on_progress is not None:
+        report = lambda entry: loop.call_soon_threadsafe(on_progress, entry)
+    return await loop.run_in_executor(
+        _executor, execute_code, user_code, test_cases, function_name, timeout, challenge_id, report
+    )
 
 
-# Example usage for testing
 if __name__ == "__main__":
     # Test case 1: Simple palindrome function
     test_code = """
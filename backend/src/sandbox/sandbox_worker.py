@@ -0,0 +1,220 @@
+"""
+Long-lived sandbox worker process.
+Reads one JSON job per line from stdin ({"code", "fn", "star", "cid", "tests",
+"progress", "nonce"}), forks a child that runs the user's code against the test cases
+and writes one JSON result line back to stdout, preceded by a {"progress"}
+line per finished test when the job asks for it. Every line echoes the
+job's nonce.
+"""
+
+import io
+import json
+import os
+import resource
+import signal
+import sys
+import traceback
+
+# Test cases by challenge_id; the parent only sends them with a worker's
+# first job. Jobs run in forked children, so user code that mutates its
+# inputs only touches its own copy-on-write pages.
+_challenge_tests: dict = {}
+
+# Limits come from sandbox_runner through the environment. The worker imports
+# nothing from the server package, so user code running in it cannot reach it.
+CPU_TIME_LIMIT = int(os.environ["SANDBOX_CPU_TIME_LIMIT"])
+MEMORY_LIMIT_MB = int(os.environ["SANDBOX_MEMORY_LIMIT_MB"])
+
+# Upper bound for the fds a forked job closes
+MAXFD = os.sysconf("SC_OPEN_MAX")
+
+
+def set_resource_limits():
+    """Cap the worker's address space and file size; CPU time is budgeted per job."""
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_MB * 1024 * 1024, MEMORY_LIMIT_MB * 1024 * 1024))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (10 * 1024 * 1024, 10 * 1024 * 1024))
+    except Exception as e:
+        print(f"Warning: Could not set resource limits: {e}", file=sys.stderr)
+
+
+def set_cpu_budget(seconds: int):
+    """
+    Allow the next job `seconds` of CPU time on top of what the worker has used.
+    Only called in a forked job. The hard limit sits a second above the soft one,
+    so SIGXCPU still arrives, but user code cannot raise its own budget.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + 1 + seconds
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 1))
+
+
+def run_tests(func, test_cases: list, star: bool = False, report=None) -> dict:
+    """
+    Test driver: call the user's function on every test case.
+    The call style is fixed per challenge, so it is chosen once up front.
+    If given, report(entry, passed) is called after each test.
+    """
+    results = []
+    passed = 0
+    call = (lambda args: func(*args)) if star else func
+
+    for i, test_case in enumerate(test_cases):
+        try:
+            input_data = test_case['input']
+            expected = test_case['expected']
+
+            # Call user's function
+            result = call(input_data)
+
+            # Normalize results for comparison
+            if result == expected:
+                entry = {"test": i+1, "status": "PASS"}
+                passed += 1
+            else:
+                entry = {"test": i+1, "status": "FAIL", "expected": repr(expected), "got": repr(result)}
+
+        except Exception as e:
+            entry = {"test": i+1, "status": "ERROR", "error": str(e), "traceback": traceback.format_exc()}
+
+        results.append(entry)
+        if report is not None:
+            report(entry, passed)
+
+    return {"passed": passed, "total": len(test_cases), "test_results": results}
+
+
+def job_tests(job: dict) -> list:
+    """Return the job's test cases, caching them under its challenge_id."""
+    cid = job.get("cid")
+    if "tests" in job:
+        if cid is not None:
+            _challenge_tests[cid] = job["tests"]
+        return job["tests"]
+    return _challenge_tests[cid]
+
+
+def run_job(job: dict, tests: list, report=None) -> dict:
+    """Execute the user's code and the test driver, capturing prints and any uncaught error."""
+    stdout = io.StringIO()
+    error = ""
+    output = None
+
+    real_stdout = sys.stdout
+    sys.stdout = stdout
+    try:
+        namespace = {"__name__": "__main__"}
+        exec(compile(job["code"], "<user>", "exec"), namespace)
+        output = run_tests(namespace[job["fn"]], tests, job.get("star", False), report)
+    except BaseException:
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = real_stdout
+
+    return {"stdout": stdout.getvalue(), "stderr": error, "result": output}
+
+
+def send(replies, message: dict, nonce):
+    """Write one reply line to the parent, tagged with the job's nonce."""
+    message["nonce"] = nonce
+    replies.write(json.dumps(message).encode() + b"\n")
+    replies.flush()
+
+
+def failed_reply(error: str) -> dict:
+    return {"stdout": "", "stderr": error, "result": None}
+
+
+def run_forked(job: dict, tests: list, replies) -> dict:
+    """
+    Run one job in a forked child and return its reply.
+    The child starts from the worker's warm, already-imported state instead
+    of a cold interpreter, and whatever the user's code leaves behind
+    (globals, patched builtins, leaked memory) dies with it.
+    Progress lines from the child are forwarded to replies as they arrive.
+    The child holds nothing but its own pipe, and its output is re-parsed
+    rather than passed through.
+    """
+    nonce = job.get("nonce")
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        status = 1
+        try:
+            # Drop every inherited fd but the reply pipe, including the job channel
+            os.closerange(3, write_fd)
+            os.closerange(write_fd + 1, MAXFD)
+            set_cpu_budget(CPU_TIME_LIMIT)
+            resource.setrlimit(resource.RLIMIT_NPROC, (1, 1))  # No forking from user code
+            with os.fdopen(write_fd, "wb") as pipe:
+                report = None
+                if job.get("progress"):
+                    def report(entry, passed):
+                        pipe.write(json.dumps({"progress": {**entry, "passed_tests": passed}}).encode() + b"\n")
+                        pipe.flush()
+                # The final reply is the only line without a trailing newline
+                pipe.write(json.dumps(run_job(job, tests, report)).encode())
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    reply = b""
+    with os.fdopen(read_fd, "rb") as pipe:
+        for line in pipe:
+            if not line.endswith(b"\n"):
+                reply = line
+                continue
+            try:
+                progress = json.loads(line)["progress"]
+            except (ValueError, KeyError, TypeError):
+                continue  # Not a progress line; never pass it through
+            send(replies, {"progress": progress}, nonce)
+    _, status = os.waitpid(pid, 0)
+
+    if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU:
+        return {"timeout": True}
+    if status != 0 or not reply:
+        return failed_reply(f"Sandbox process exited with code {os.waitstatus_to_exitcode(status)}")
+    try:
+        result = json.loads(reply)
+        return {"stdout": result["stdout"], "stderr": result["stderr"], "result": result["result"]}
+    except (ValueError, KeyError, TypeError):
+        return failed_reply("Sandbox process sent an invalid reply")
+
+
+def open_channel():
+    """
+    Move the job pipe off stdin/stdout so user code (input(), exit(), stray
+    writes) can neither read the next job nor corrupt a reply.
+    """
+    requests = os.fdopen(os.dup(0), "r")
+    replies = os.fdopen(os.dup(1), "wb")
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    return requests, replies
+
+
+def main():
+    requests, replies = open_channel()
+
+    # CPU time and the process cap apply to each forked job instead; a
+    # cumulative CPU cap would kill the worker and NPROC=1 would stop it forking
+    set_resource_limits()
+
+    while True:
+        line = requests.readline()
+        if not line:
+            break  # Parent closed the pipe
+
+        job = json.loads(line)
+        send(replies, run_forked(job, job_tests(job), replies), job.get("nonce"))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,12 @@ from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple
 from enum import Enum
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
 import asyncio
+import sys
+
+from sortedcontainers import SortedKeyList, SortedList
 
 
 class BattleStatus(Enum):
@@ -19,25 +23,39 @@ class BattleStatus(Enum):
     ABANDONED = "abandoned"
 
 
-@dataclass
+# Enum member -> wire value, avoids the .value descriptor on every broadcast
+_STATUS_VALUES = {status: status.value for status in BattleStatus}
+
+# Timestamps are time.monotonic_ns() ints; this offset maps them onto wall-clock UTC
+_EPOCH = datetime(1970, 1, 1)
+_WALL_CLOCK_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def _ns_to_iso(monotonic_ns: int) -> str:
+    """Format a monotonic_ns timestamp as a naive UTC ISO string."""
+    return (_EPOCH + timedelta(microseconds=(monotonic_ns + _WALL_CLOCK_OFFSET_NS) // 1000)).isoformat()
+
+
+@dataclass(slots=True)
 class Player:
     """Represents a player in the queue."""
     user_id: str
     username: str
     elo_rating: int = 1000
-    queue_time: datetime = field(default_factory=datetime.utcnow)
+    queue_time_ns: int = field(default_factory=time.monotonic_ns)
     socket_id: str = ""
+    challenge_id: str = ""
     
-    def __hash__(self):
+    def __hash__(self) -> int:
         return hash(self.user_id)
     
-    def __eq__(self, other):
+    def __eq__(self, other: object) -> bool:
         if isinstance(other, Player):
             return self.user_id == other.user_id
         return False
 
 
-@dataclass
+@dataclass(slots=True)
 class BattleRoom:
     """Represents a 1v1 battle room."""
     room_id: str
@@ -45,9 +63,9 @@ class BattleRoom:
     player2: Player
     challenge_id: str
     status: BattleStatus = BattleStatus.WAITING
-    created_at: datetime = field(default_factory=datetime.utcnow)
-    started_at: Optional[datetime] = None
-    completed_at: Optional[datetime] = None
+    created_at_ns: int = field(default_factory=time.monotonic_ns)
+    started_at_ns: Optional[int] = None
+    completed_at_ns: Optional[int] = None
     
     # Player code and progress
     player1_code: str = ""
@@ -61,63 +79,92 @@ class BattleRoom:
     
     def to_dict(self) -> dict:
         """Convert battle room to dictionary."""
+        p1 = self.player1
+        p2 = self.player2
         return {
             "room_id": self.room_id,
             "player1": {
-                "user_id": self.player1.user_id,
-                "username": self.player1.username,
-                "elo_rating": self.player1.elo_rating,
+                "user_id": p1.user_id,
+                "username": p1.username,
+                "elo_rating": p1.elo_rating,
                 "code": self.player1_code,
                 "tests_passed": self.player1_tests_passed,
             },
             "player2": {
-                "user_id": self.player2.user_id,
-                "username": self.player2.username,
-                "elo_rating": self.player2.elo_rating,
+                "user_id": p2.user_id,
+                "username": p2.username,
+                "elo_rating": p2.elo_rating,
                 "code": self.player2_code,
                 "tests_passed": self.player2_tests_passed,
             },
             "challenge_id": self.challenge_id,
-            "status": self.status.value,
+            "status": _STATUS_VALUES[self.status],
             "total_tests": self.total_tests,
             "winner_id": self.winner_id,
-            "created_at": self.created_at.isoformat(),
+            "created_at": _ns_to_iso(self.created_at_ns),
         }
 
 
+def _elo_key(player: Player) -> Tuple[int, int, str]:
+    """Sort key for the ELO index: rating, then longest waiting, then user_id as a tiebreak."""
+    return (player.elo_rating, player.queue_time_ns, player.user_id)
+
+
+def _join_key(player: Player) -> Tuple[int, str]:
+    """Sort key for the join-order index: longest waiting first."""
+    return (player.queue_time_ns, player.user_id)
+
+
 class MatchmakingQueue:
     """
     Manages the matchmaking queue and battle room creation.
     Uses ELO-based ranking for fair pairings.
     """
     
-    def __init__(self):
-        self.queue: List[Player] = []
+    def __init__(self) -> None:
+        # Players are only matched within the challenge they asked for, so each
+        # challenge_id gets its own pair of indexes
+        self.queue_by_join: Dict[str, SortedKeyList] = {}  # Longest waiting first, O(log n) rank
+        self.queue_by_elo: Dict[str, SortedKeyList] = {}  # Nearest-rating lookups
+        self.queued_elos = SortedList()  # Every queued rating, for the median and percentiles
         self.battle_rooms: Dict[str, BattleRoom] = {}
         self.player_to_room: Dict[str, str] = {}  # user_id -> room_id
         self.players_in_queue: Dict[str, Player] = {}  # user_id -> Player
+        self._elo_sum: int = 0  # Sum of queued players' ratings, for the average
     
     def add_to_queue(self, user_id: str, username: str, elo_rating: int = 1000, 
-                     socket_id: str = "") -> Player:
+                     socket_id: str = "", challenge_id: str = "") -> Player:
         """
-        Add a player to the matchmaking queue.
+        Add a player to the matchmaking queue for a challenge.
         Returns the Player object.
         """
+        # Interned ids let the per-tick dict lookups compare by identity
+        user_id = sys.intern(user_id)
+        
         # Check if player already in queue
-        if user_id in self.players_in_queue:
-            player = self.players_in_queue[user_id]
-            player.socket_id = socket_id  # Update socket in case of reconnect
-            return player
+        player = self.players_in_queue.get(user_id)
+        if player is not None:
+            if player.challenge_id == challenge_id:
+                player.socket_id = socket_id  # Update socket in case of reconnect
+                return player
+            self.remove_from_queue(user_id)  # Switching challenges requeues at the back
         
         player = Player(
             user_id=user_id,
             username=username,
             elo_rating=elo_rating,
-            socket_id=socket_id
+            socket_id=socket_id,
+            challenge_id=challenge_id
         )
         
-        self.queue.append(player)
+        if challenge_id not in self.queue_by_join:
+            self.queue_by_join[challenge_id] = SortedKeyList(key=_join_key)
+            self.queue_by_elo[challenge_id] = SortedKeyList(key=_elo_key)
+        self.queue_by_join[challenge_id].add(player)
+        self.queue_by_elo[challenge_id].add(player)
+        self.queued_elos.add(elo_rating)
         self.players_in_queue[user_id] = player
+        self._elo_sum += elo_rating
         
         return player
     
@@ -125,54 +172,79 @@ class MatchmakingQueue:
         """Remove a player from the queue."""
         if user_id in self.players_in_queue:
             player = self.players_in_queue[user_id]
-            self.queue.remove(player)
+            by_join = self.queue_by_join[player.challenge_id]
+            by_join.remove(player)
+            self.queue_by_elo[player.challenge_id].remove(player)
+            if not by_join:
+                # Challenge ids come from clients; don't keep empty queues around
+                del self.queue_by_join[player.challenge_id]
+                del self.queue_by_elo[player.challenge_id]
+            self.queued_elos.remove(player.elo_rating)
+            self._elo_sum -= player.elo_rating
             del self.players_in_queue[user_id]
             return player
         
         return None
     
-    def find_best_match(self, player: Player, elo_tolerance: int = 200) -> Optional[Player]:
+    def get_queue_position(self, user_id: str) -> Optional[int]:
+        """
+        Get a player's 1-based position in join order among players waiting
+        for the same challenge, or None if not queued.
+        """
+        player = self.players_in_queue.get(user_id)
+        if player is None:
+            return None
+        return self.queue_by_join[player.challenge_id].bisect_key_left(_join_key(player)) + 1
+    
+    def find_best_match(self, player: Player) -> Optional[Player]:
         """
         Find the best opponent for a player based on ELO rating.
+        Looks at the nearest ratings on either side of the player in their
+        challenge's ELO index, so the cost is O(log n) in that queue's size.
+        The closest rating always wins, however far away it is; ties go to
+        whoever has waited longest.
         Returns the opponent player or None if no suitable match found.
         """
-        if len(self.queue) < 2:
+        by_elo = self.queue_by_elo.get(player.challenge_id)
+        if by_elo is None or len(by_elo) < 2:
             return None
         
-        # Remove the searching player from queue temporarily
-        remaining_players = [p for p in self.queue if p.user_id != player.user_id]
+        # irange_key walks the index's sublists directly; positional lookups
+        # (by_elo[i]) would make the index maintain a position tree on every
+        # add and remove
+        rating = player.elo_rating
+        candidates: List[Player] = []
         
-        if not remaining_players:
-            return None
-        
-        # Find player with closest ELO rating within tolerance
-        best_match = None
-        closest_diff = float('inf')
+        # Nearest rating at or above the player's, skipping the player itself
+        for above in by_elo.irange_key(min_key=(rating,)):
+            if above != player:
+                if above.elo_rating == rating:
+                    return above  # Exact rating, longest waiting; nothing below can beat it
+                candidates.append(above)
+                break
         
-        for candidate in remaining_players:
-            elo_diff = abs(player.elo_rating - candidate.elo_rating)
-            
-            if elo_diff < closest_diff and elo_diff <= elo_tolerance:
-                closest_diff = elo_diff
-                best_match = candidate
+        # Nearest rating below the player's; take the longest waiting at that rating
+        for lower in by_elo.irange_key(max_key=(rating,), inclusive=(True, False), reverse=True):
+            candidates.append(next(by_elo.irange_key(min_key=(lower.elo_rating,))))
+            break
         
-        # If no match within tolerance, pick closest one
-        if best_match is None and remaining_players:
-            best_match = min(remaining_players, 
-                           key=lambda p: abs(player.elo_rating - p.elo_rating))
+        if not candidates:
+            return None
         
-        return best_match
+        return min(candidates,
+                   key=lambda p: (abs(player.elo_rating - p.elo_rating), p.queue_time_ns))
     
     def attempt_matchmaking(self, challenge_id: str) -> Optional[BattleRoom]:
         """
-        Attempt to create a match for the longest waiting player.
+        Attempt to create a match for the longest waiting player on a challenge.
         Returns BattleRoom if a match is made, None otherwise.
         """
-        if len(self.queue) < 2:
+        by_join = self.queue_by_join.get(challenge_id)
+        if by_join is None or len(by_join) < 2:
             return None
         
         # Get the player who's been waiting the longest
-        player1 = self.queue[0]
+        player1 = by_join[0]
         
         # Find best opponent
         player2 = self.find_best_match(player1)
@@ -197,7 +269,7 @@ class MatchmakingQueue:
     def _create_battle_room(self, player1: Player, player2: Player, 
                            challenge_id: str) -> BattleRoom:
         """Create a new battle room."""
-        room_id = f"room_{uuid.uuid4().hex[:12]}"
+        room_id = sys.intern(f"room_{uuid.uuid4().hex[:12]}")
         
         battle_room = BattleRoom(
             room_id=room_id,
@@ -237,9 +309,13 @@ class MatchmakingQueue:
     
     def update_test_results(self, room_id: str, player_id: str, 
                           tests_passed: int, total_tests: int) -> bool:
-        """Update test results for a player."""
+        """
+        Update test results for a player; passing every test wins the battle.
+        Returns False if nothing was recorded, including results that arrive
+        after the battle already has a winner.
+        """
         battle_room = self.get_battle_room(room_id)
-        if not battle_room:
+        if not battle_room or battle_room.winner_id is not None:
             return False
         
         battle_room.total_tests = total_tests
@@ -253,19 +329,23 @@ class MatchmakingQueue:
         
         # Check if someone won
         if tests_passed == total_tests:
-            self._end_battle(room_id, player_id)
+            return self._end_battle(room_id, player_id)
         
         return True
     
-    def _end_battle(self, room_id: str, winner_id: str):
-        """End a battle and mark the winner."""
+    def _end_battle(self, room_id: str, winner_id: str) -> bool:
+        """
+        End a battle and mark the winner. Only the first call wins; returns
+        False if the battle already has a winner.
+        """
         battle_room = self.get_battle_room(room_id)
-        if not battle_room:
-            return
+        if not battle_room or battle_room.winner_id is not None:
+            return False
         
         battle_room.status = BattleStatus.COMPLETED
         battle_room.winner_id = winner_id
-        battle_room.completed_at = datetime.utcnow()
+        battle_room.completed_at_ns = time.monotonic_ns()
+        return True
     
     def start_battle(self, room_id: str) -> bool:
         """Start a battle room."""
@@ -274,22 +354,63 @@ class MatchmakingQueue:
             return False
         
         battle_room.status = BattleStatus.IN_PROGRESS
-        battle_room.started_at = datetime.utcnow()
+        battle_room.started_at_ns = time.monotonic_ns()
         return True
     
-    def get_queue_size(self) -> int:
-        """Get current queue size."""
-        return len(self.queue)
+    def forfeit_battle(self, room_id: str, user_id: str) -> Optional[Player]:
+        """
+        End a battle that user_id left by awarding it to their opponent.
+        Returns the winner, or None if the room is gone or already has one.
+        """
+        battle_room = self.get_battle_room(room_id)
+        if not battle_room:
+            return None
+        
+        winner = battle_room.player2 if user_id == battle_room.player1.user_id else battle_room.player1
+        return winner if self._end_battle(room_id, winner.user_id) else None
+    
+    def close_battle_room(self, room_id: str) -> Optional[BattleRoom]:
+        """
+        Drop a finished room and its players' room mappings so completed
+        battles do not accumulate in memory. Returns the removed room.
+        """
+        battle_room = self.battle_rooms.pop(room_id, None)
+        if battle_room is None:
+            return None
+        
+        for player in (battle_room.player1, battle_room.player2):
+            # The player may already be mapped to a newer room
+            if self.player_to_room.get(player.user_id) == room_id:
+                del self.player_to_room[player.user_id]
+        
+        return battle_room
+    
+    def get_queue_size(self, challenge_id: Optional[str] = None) -> int:
+        """Get current queue size, overall or for one challenge."""
+        if challenge_id is None:
+            return len(self.players_in_queue)
+        by_join = self.queue_by_join.get(challenge_id)
+        return len(by_join) if by_join is not None else 0
+    
+    def elo_percentile(self, pct: float) -> int:
+        """
+        Rating at the given percentile (nearest rank) of the queue, or 0 if empty.
+        Reads straight from the sorted ratings, O(log n).
+        """
+        elos = self.queued_elos
+        if not elos:
+            return 0
+        rank = min(len(elos) - 1, int(len(elos) * pct / 100))
+        return elos[rank]
     
     def get_queue_info(self) -> dict:
         """Get queue statistics."""
         return {
-            "queue_size": len(self.queue),
+            "queue_size": len(self.players_in_queue),
             "active_battles": len(self.battle_rooms),
-            "average_elo": (
-                sum(p.elo_rating for p in self.queue) / len(self.queue)
-                if self.queue else 0
-            ),
+            "average_elo": self._elo_sum / max(1, len(self.players_in_queue)),
+            "median_elo": self.elo_percentile(50),
+            "challenge_queues": {cid: len(q) for cid, q in self.queue_by_join.items()},
         }
 
 
@@ -1,15 +1,16 @@
 from dataclasses import dataclass
-from typing import List, Any
+import json
+from typing import Dict, List, Any, Optional, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class TestCase:
     input_data: Any
     expected_output: Any
     description: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Challenge:
     id: str
     name: str
@@ -109,3 +110,64 @@ CHALLENGES = {
 
 def get_challenge(challenge_id: str) -> Challenge:
     return CHALLENGES.get(challenge_id)
+
+
+def _challenge_summary(challenge: Challenge) -> dict:
+    return {
+        'id': challenge.id,
+        'name': challenge.name,
+        'description': challenge.description,
+        'difficulty': challenge.difficulty,
+        'time_limit': challenge.time_limit,
+        'test_count': len(challenge.test_cases),
+    }
+
+
+def _challenge_detail(challenge: Challenge) -> dict:
+    return {
+        'id': challenge.id,
+        'name': challenge.name,
+        'description': challenge.description,
+        'difficulty': challenge.difficulty,
+        'time_limit': challenge.time_limit,
+        'function_signature': challenge.function_signature,
+        'example_code': challenge.example_code,
+        'test_count': len(challenge.test_cases),
+    }
+
+
+_CHALLENGE_DICT_CACHE: Dict[str, dict] = {
+    cid: _challenge_detail(c) for cid, c in CHALLENGES.items()
+}
+
+
+def get_challenge_dict(challenge_id: str) -> Optional[dict]:
+    return _CHALLENGE_DICT_CACHE.get(challenge_id)
+
+
+def _function_name(signature: str) -> str:
+    return signature.split('(')[0].removeprefix('def ').strip()
+
+
+_TEST_SPEC_CACHE: Dict[str, Tuple[str, List[Dict[str, Any]]]] = {
+    cid: (
+        _function_name(c.function_signature),
+        [{'input': tc.input_data, 'expected': tc.expected_output} for tc in c.test_cases],
+    )
+    for cid, c in CHALLENGES.items()
+}
+
+
+def get_test_spec(challenge_id: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    return _TEST_SPEC_CACHE.get(challenge_id)
+
+
+ALL_CHALLENGES_JSON: bytes = json.dumps(
+    {"challenges": [_challenge_summary(c) for c in CHALLENGES.values()]},
+    ensure_ascii=False,
+    separators=(",", ":"),
+).encode("utf-8")
+
+
+def get_all_challenges_json() -> bytes:
+    return ALL_CHALLENGES_JSON
@@ -49,6 +49,8 @@ export default function App() {
 
   // Socket and UI state
   const socketRef = useRef(null)
+  const userIdRef = useRef(null) // Read by socket handlers, which are registered once
+  const usernameRef = useRef('')
   const [connectionStatus, setConnectionStatus] = useState('disconnected')
   const [opponent, setOpponent] = useState(null)
   const [notifications, setNotifications] = useState([])
@@ -67,6 +69,14 @@ export default function App() {
       socketRef.current.on('connect', () => {
         setConnectionStatus('connected')
         console.log('Connected to server:', socketRef.current.id)
+        // After a reconnect, register again so the server puts us back in our battle
+        if (userIdRef.current) {
+          socketRef.current.emit('register_user', {
+            user_id: userIdRef.current,
+            username: usernameRef.current,
+            elo_rating: 1000,
+          })
+        }
       })
 
       socketRef.current.on('disconnect', () => {
@@ -99,9 +109,10 @@ export default function App() {
       })
 
       socketRef.current.on('match_found', (data) => {
+        const opponent = data.players.find((p) => p.socket_id !== socketRef.current.id)
         setRoomId(data.room_id)
         setChallenge(data.challenge)
-        setOpponent(data.opponent)
+        setOpponent(opponent)
         setInQueue(false)
         setInBattle(true)
         setUserCode('')
@@ -110,18 +121,18 @@ export default function App() {
         setOpponentTestsPassed(0)
         setTotalTests(data.challenge.test_count)
         setBattleResult(null)
-        addNotification(`Match found! Facing ${data.opponent.username}`)
+        addNotification(`Match found! Facing ${opponent.username}`)
       })
 
       socketRef.current.on('code_submission', (data) => {
-        if (data.user_id === userId) {
+        if (data.user_id === userIdRef.current) {
           setUserTestsPassed(data.passed_tests)
         } else {
           setOpponentTestsPassed(data.passed_tests)
         }
 
         addNotification(
-          `${data.user_id === userId ? 'You' : 'Opponent'}: ${data.passed_tests}/${data.total_tests} tests passed`
+          `${data.user_id === userIdRef.current ? 'You' : 'Opponent'}: ${data.passed_tests}/${data.total_tests} tests passed`
         )
 
         if (!data.success && data.error) {
@@ -129,6 +140,15 @@ export default function App() {
         }
       })
 
+      // Running pass count while a submission's remaining tests are still executing
+      socketRef.current.on('test_progress', (data) => {
+        if (data.user_id === userIdRef.current) {
+          setUserTestsPassed(data.passed_tests)
+        } else {
+          setOpponentTestsPassed(data.passed_tests)
+        }
+      })
+
       socketRef.current.on('opponent_code_update', (data) => {
         setOpponentCode(data.code)
       })
@@ -180,6 +200,8 @@ export default function App() {
 
     const newUserId = `user_${Date.now()}`
     setUserId(newUserId)
+    userIdRef.current = newUserId
+    usernameRef.current = username.trim()
     setIsLoggedIn(true)
 
     console.log('📤 EMIT register_user event:', {
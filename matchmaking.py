@@ -1,8 +1,12 @@
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from enum import Enum
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
+import sys
+
+from sortedcontainers import SortedKeyList, SortedList
 
 
 class BattleStatus(Enum):
@@ -12,33 +16,44 @@ class BattleStatus(Enum):
     ABANDONED = "abandoned"
 
 
-@dataclass
+_STATUS_VALUES = {status: status.value for status in BattleStatus}
+
+_EPOCH = datetime(1970, 1, 1)
+_WALL_CLOCK_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def _ns_to_iso(monotonic_ns: int) -> str:
+    return (_EPOCH + timedelta(microseconds=(monotonic_ns + _WALL_CLOCK_OFFSET_NS) // 1000)).isoformat()
+
+
+@dataclass(slots=True)
 class Player:
     user_id: str
     username: str
     elo_rating: int = 1000
-    queue_time: datetime = field(default_factory=datetime.utcnow)
+    queue_time_ns: int = field(default_factory=time.monotonic_ns)
     socket_id: str = ""
+    challenge_id: str = ""
     
-    def __hash__(self):
+    def __hash__(self) -> int:
         return hash(self.user_id)
     
-    def __eq__(self, other):
+    def __eq__(self, other: object) -> bool:
         if isinstance(other, Player):
             return self.user_id == other.user_id
         return False
 
 
-@dataclass
+@dataclass(slots=True)
 class BattleRoom:
     room_id: str
     player1: Player
     player2: Player
     challenge_id: str
     status: BattleStatus = BattleStatus.WAITING
-    created_at: datetime = field(default_factory=datetime.utcnow)
-    started_at: Optional[datetime] = None
-    completed_at: Optional[datetime] = None
+    created_at_ns: int = field(default_factory=time.monotonic_ns)
+    started_at_ns: Optional[int] = None
+    completed_at_ns: Optional[int] = None
     
     player1_code: str = ""
     player2_code: str = ""
@@ -49,96 +64,134 @@ class BattleRoom:
     winner_id: Optional[str] = None
     
     def to_dict(self) -> dict:
+        p1 = self.player1
+        p2 = self.player2
         return {
             "room_id": self.room_id,
             "player1": {
-                "user_id": self.player1.user_id,
-                "username": self.player1.username,
-                "elo_rating": self.player1.elo_rating,
+                "user_id": p1.user_id,
+                "username": p1.username,
+                "elo_rating": p1.elo_rating,
                 "code": self.player1_code,
                 "tests_passed": self.player1_tests_passed,
             },
             "player2": {
-                "user_id": self.player2.user_id,
-                "username": self.player2.username,
-                "elo_rating": self.player2.elo_rating,
+                "user_id": p2.user_id,
+                "username": p2.username,
+                "elo_rating": p2.elo_rating,
                 "code": self.player2_code,
                 "tests_passed": self.player2_tests_passed,
             },
             "challenge_id": self.challenge_id,
-            "status": self.status.value,
+            "status": _STATUS_VALUES[self.status],
             "total_tests": self.total_tests,
             "winner_id": self.winner_id,
-            "created_at": self.created_at.isoformat(),
+            "created_at": _ns_to_iso(self.created_at_ns),
         }
 
 
+def _elo_key(player: Player) -> Tuple[int, int, str]:
+    return (player.elo_rating, player.queue_time_ns, player.user_id)
+
+
+def _join_key(player: Player) -> Tuple[int, str]:
+    return (player.queue_time_ns, player.user_id)
+
+
 class MatchmakingQueue:
     
-    def __init__(self):
-        self.queue: List[Player] = []
+    def __init__(self) -> None:
+        self.queue_by_join: Dict[str, SortedKeyList] = {}
+        self.queue_by_elo: Dict[str, SortedKeyList] = {}
+        self.queued_elos = SortedList()
         self.battle_rooms: Dict[str, BattleRoom] = {}
         self.player_to_room: Dict[str, str] = {}
         self.players_in_queue: Dict[str, Player] = {}
+        self._elo_sum: int = 0
     
     def add_to_queue(self, user_id: str, username: str, elo_rating: int = 1000, 
-                     socket_id: str = "") -> Player:
-        if user_id in self.players_in_queue:
-            player = self.players_in_queue[user_id]
-            player.socket_id = socket_id
-            return player
+                     socket_id: str = "", challenge_id: str = "") -> Player:
+        user_id = sys.intern(user_id)
+        
+        player = self.players_in_queue.get(user_id)
+        if player is not None:
+            if player.challenge_id == challenge_id:
+                player.socket_id = socket_id
+                return player
+            self.remove_from_queue(user_id)
         
         player = Player(
             user_id=user_id,
             username=username,
             elo_rating=elo_rating,
-            socket_id=socket_id
+            socket_id=socket_id,
+            challenge_id=challenge_id
         )
         
-        self.queue.append(player)
+        if challenge_id not in self.queue_by_join:
+            self.queue_by_join[challenge_id] = SortedKeyList(key=_join_key)
+            self.queue_by_elo[challenge_id] = SortedKeyList(key=_elo_key)
+        self.queue_by_join[challenge_id].add(player)
+        self.queue_by_elo[challenge_id].add(player)
+        self.queued_elos.add(elo_rating)
         self.players_in_queue[user_id] = player
+        self._elo_sum += elo_rating
         
         return player
     
     def remove_from_queue(self, user_id: str) -> Optional[Player]:
         if user_id in self.players_in_queue:
             player = self.players_in_queue[user_id]
-            self.queue.remove(player)
+            by_join = self.queue_by_join[player.challenge_id]
+            by_join.remove(player)
+            self.queue_by_elo[player.challenge_id].remove(player)
+            if not by_join:
+                del self.queue_by_join[player.challenge_id]
+                del self.queue_by_elo[player.challenge_id]
+            self.queued_elos.remove(player.elo_rating)
+            self._elo_sum -= player.elo_rating
             del self.players_in_queue[user_id]
             return player
         
         return None
     
-    def find_best_match(self, player: Player, elo_tolerance: int = 200) -> Optional[Player]:
-        if len(self.queue) < 2:
+    def get_queue_position(self, user_id: str) -> Optional[int]:
+        player = self.players_in_queue.get(user_id)
+        if player is None:
             return None
-        
-        remaining_players = [p for p in self.queue if p.user_id != player.user_id]
-        
-        if not remaining_players:
+        return self.queue_by_join[player.challenge_id].bisect_key_left(_join_key(player)) + 1
+    
+    def find_best_match(self, player: Player) -> Optional[Player]:
+        by_elo = self.queue_by_elo.get(player.challenge_id)
+        if by_elo is None or len(by_elo) < 2:
             return None
         
-        best_match = None
-        closest_diff = float('inf')
+        rating = player.elo_rating
+        candidates: List[Player] = []
         
-        for candidate in remaining_players:
-            elo_diff = abs(player.elo_rating - candidate.elo_rating)
-            
-            if elo_diff < closest_diff and elo_diff <= elo_tolerance:
-                closest_diff = elo_diff
-                best_match = candidate
+        for above in by_elo.irange_key(min_key=(rating,)):
+            if above != player:
+                if above.elo_rating == rating:
+                    return above
+                candidates.append(above)
+                break
         
-        if best_match is None and remaining_players:
-            best_match = min(remaining_players, 
-                           key=lambda p: abs(player.elo_rating - p.elo_rating))
+        for lower in by_elo.irange_key(max_key=(rating,), inclusive=(True, False), reverse=True):
+            candidates.append(next(by_elo.irange_key(min_key=(lower.elo_rating,))))
+            break
         
-        return best_match
+        if not candidates:
+            return None
+        
+        return min(candidates,
+                   key=lambda p: (abs(player.elo_rating - p.elo_rating), p.queue_time_ns))
     
     def attempt_matchmaking(self, challenge_id: str) -> Optional[BattleRoom]:
-        if len(self.queue) < 2:
+        by_join = self.queue_by_join.get(challenge_id)
+        if by_join is None or len(by_join) < 2:
             return None
         
-        player1 = self.queue[0]
+        player1 = by_join[0]
         player2 = self.find_best_match(player1)
         
         if player2 is None:
@@ -157,7 +210,7 @@ class MatchmakingQueue:
     
     def _create_battle_room(self, player1: Player, player2: Player, 
                            challenge_id: str) -> BattleRoom:
-        room_id = f"room_{uuid.uuid4().hex[:12]}"
+        room_id = sys.intern(f"room_{uuid.uuid4().hex[:12]}")
         
         battle_room = BattleRoom(
             room_id=room_id,
@@ -195,7 +248,7 @@ class MatchmakingQueue:
     def update_test_results(self, room_id: str, player_id: str, 
                           tests_passed: int, total_tests: int) -> bool:
         battle_room = self.get_battle_room(room_id)
-        if not battle_room:
+        if not battle_room or battle_room.winner_id is not None:
             return False
         
         battle_room.total_tests = total_tests
@@ -208,18 +261,19 @@ class MatchmakingQueue:
             return False
         
         if tests_passed == total_tests:
-            self._end_battle(room_id, player_id)
+            return self._end_battle(room_id, player_id)
         
         return True
     
-    def _end_battle(self, room_id: str, winner_id: str):
+    def _end_battle(self, room_id: str, winner_id: str) -> bool:
         battle_room = self.get_battle_room(room_id)
-        if not battle_room:
-            return
+        if not battle_room or battle_room.winner_id is not None:
+            return False
         
         battle_room.status = BattleStatus.COMPLETED
         battle_room.winner_id = winner_id
-        battle_room.completed_at = datetime.utcnow()
+        battle_room.completed_at_ns = time.monotonic_ns()
+        return True
     
     def start_battle(self, room_id: str) -> bool:
         battle_room = self.get_battle_room(room_id)
@@ -227,20 +281,48 @@ class MatchmakingQueue:
             return False
         
         battle_room.status = BattleStatus.IN_PROGRESS
-        battle_room.started_at = datetime.utcnow()
+        battle_room.started_at_ns = time.monotonic_ns()
         return True
     
-    def get_queue_size(self) -> int:
-        return len(self.queue)
+    def forfeit_battle(self, room_id: str, user_id: str) -> Optional[Player]:
+        battle_room = self.get_battle_room(room_id)
+        if not battle_room:
+            return None
+        
+        winner = battle_room.player2 if user_id == battle_room.player1.user_id else battle_room.player1
+        return winner if self._end_battle(room_id, winner.user_id) else None
+    
+    def close_battle_room(self, room_id: str) -> Optional[BattleRoom]:
+        battle_room = self.battle_rooms.pop(room_id, None)
+        if battle_room is None:
+            return None
+        
+        for player in (battle_room.player1, battle_room.player2):
+            if self.player_to_room.get(player.user_id) == room_id:
+                del self.player_to_room[player.user_id]
+        
+        return battle_room
+    
+    def get_queue_size(self, challenge_id: Optional[str] = None) -> int:
+        if challenge_id is None:
+            return len(self.players_in_queue)
+        by_join = self.queue_by_join.get(challenge_id)
+        return len(by_join) if by_join is not None else 0
+    
+    def elo_percentile(self, pct: float) -> int:
+        elos = self.queued_elos
+        if not elos:
+            return 0
+        rank = min(len(elos) - 1, int(len(elos) * pct / 100))
+        return elos[rank]
     
     def get_queue_info(self) -> dict:
         return {
-            "queue_size": len(self.queue),
+            "queue_size": len(self.players_in_queue),
             "active_battles": len(self.battle_rooms),
-            "average_elo": (
-                sum(p.elo_rating for p in self.queue) / len(self.queue)
-                if self.queue else 0
-            ),
+            "average_elo": self._elo_sum / max(1, len(self.players_in_queue)),
+            "median_elo": self.elo_percentile(50),
+            "challenge_queues": {cid: len(q) for cid, q in self.queue_by_join.items()},
         }
 
 
@@ -1,15 +1,25 @@
+import ast
+import asyncio
+import queue
+import re
+import secrets
+import select
+import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import os
-from typing import Tuple, Dict, Any, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple, Dict, Any, List, Optional
 from dataclasses import dataclass
 import json
 import resource
 from pathlib import Path
 
 
-@dataclass
+@dataclass(slots=True)
 class ExecutionResult:
     success: bool
     passed_tests: int
@@ -20,50 +30,100 @@ class ExecutionResult:
     execution_time: float
 
 
-FORBIDDEN_IMPORTS = {
+FORBIDDEN_IMPORTS = frozenset({
     'os', 'sys', 'subprocess', 'shutil', 'socket', 'requests',
     'urllib', 'http', 'ftplib', 'smtplib', 'ssl', 'pty', 'pwd',
     'grp', 'crypt', '__import__', 'eval', 'exec', 'compile',
     'open', 'input', 'raw_input', 'importlib', 'pkgutil',
     'modulefinder', 'runpy', 'code', 'codeop', 'tracemalloc',
     'asyncio', 'threading', 'multiprocessing', 'concurrent',
-}
+    'io', '_io', 'posix', 'resource', '__main__', 'sandbox', 'sandbox_runner', 'sandbox_worker',
+})
+
+
+FORBIDDEN_CALLS = frozenset({'eval', 'exec', 'compile', '__import__', 'open'})
+
+
+FORBIDDEN_TOKENS = (
+    '__import__', '__builtins__', '__subclasses__', '__globals__',
+    '__bases__', '__mro__', '__code__', '__loader__',
+)
+
+
+_FORBIDDEN_TOKEN_RE = re.compile('|'.join(map(re.escape, FORBIDDEN_TOKENS)))
+
+
+def find_forbidden_token(code: str) -> Optional[str]:
+    match = _FORBIDDEN_TOKEN_RE.search(code)
+    return match.group() if match else None
+
+
+class ImportChecker(ast.NodeVisitor):
+
+    def __init__(self):
+        self.imports = set()
+        self.calls = set()
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            root = alias.name.split('.')[0]
+            if root in FORBIDDEN_IMPORTS:
+                self.imports.add(root)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        if node.module and node.level == 0:
+            root = node.module.split('.')[0]
+            if root in FORBIDDEN_IMPORTS:
+                self.imports.add(root)
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in FORBIDDEN_CALLS:
+            self.calls.add(node.func.id)
+        self.generic_visit(node)
 
 
 def check_forbidden_imports(code: str) -> Tuple[bool, str]:
-    forbidden_found = []
-
-    for forbidden in FORBIDDEN_IMPORTS:
-        patterns = [
-            f"import {forbidden}",
-            f"from {forbidden}",
-            f"import {forbidden} ",
-            f"from {forbidden} ",
-        ]
-
-        for pattern in patterns:
-            if pattern in code:
-                forbidden_found.append(forbidden)
-                break
+    token = find_forbidden_token(code)
+    if token is not None:
+        return False, f"Forbidden name detected: {token}"
 
-    if forbidden_found:
-        return False, f"Forbidden imports detected: {', '.join(set(forbidden_found))}"
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return False, f"Syntax error on line {e.lineno}: {e.msg}"
+
+    checker = ImportChecker()
+    checker.visit(tree)
+
+    if checker.imports:
+        return False, f"Forbidden imports detected: {', '.join(sorted(checker.imports))}"
+    if checker.calls:
+        return False, f"Forbidden calls detected: {', '.join(sorted(checker.calls))}"
 
     return True, ""
 
 
-def build_test_wrapper(user_code: str, test_cases: List[Dict[str, Any]],
-                       function_name: str) -> str:
-    test_cases_json = json.dumps(test_cases)
+_WRAPPER_CACHE: Dict[Tuple[str, str], str] = {}
+
+_USER_CODE_SLOT = "{USER_CODE}"
 
-    wrapper = f'''
+
+def uses_star_args(test_cases: List[Dict[str, Any]]) -> bool:
+    return bool(test_cases) and isinstance(test_cases[0]['input'], tuple)
+
+
+def _build_wrapper_template(test_cases: List[Dict[str, Any]], function_name: str) -> str:
+    test_cases_json = json.dumps(test_cases, separators=(',', ':'))
+    call_args = "*input_data" if uses_star_args(test_cases) else "input_data"
+
+    return f'''
 import json
 import sys
 import traceback
 
-{user_code}
+{_USER_CODE_SLOT}
 
-test_cases = {test_cases_json}
+test_cases = json.loads({test_cases_json!r})
 results = []
 passed = 0
 total = len(test_cases)
@@ -73,18 +133,13 @@ for i, test_case in enumerate(test_cases):
         input_data = test_case['input']
         expected = test_case['expected']
 
-        if isinstance(input_data, tuple):
-            result = {function_name}(*input_data)
-        elif isinstance(input_data, list):
-            result = {function_name}(*input_data)
-        else:
-            result = {function_name}(input_data)
+        result = {function_name}({call_args})
 
         if result == expected:
-            results.append({{"test": i+1, "status": "PASS", "expected": str(expected), "got": str(result)}})
+            results.append({{"test": i+1, "status": "PASS"}})
             passed += 1
         else:
-            results.append({{"test": i+1, "status": "FAIL", "expected": str(expected), "got": str(result)}})
+            results.append({{"test": i+1, "status": "FAIL", "expected": repr(expected), "got": repr(result)}})
 
     except Exception as e:
         results.append({{"test": i+1, "status": "ERROR", "error": str(e), "traceback": traceback.format_exc()}})
@@ -98,21 +153,216 @@ output = {{
 print(json.dumps(output))
 '''
 
-    return wrapper
+
+def build_test_wrapper(user_code: str, test_cases: List[Dict[str, Any]],
+                       function_name: str, challenge_id: Optional[str] = None) -> str:
+    if challenge_id is None:
+        template = _build_wrapper_template(test_cases, function_name)
+    else:
+        key = (challenge_id, function_name)
+        template = _WRAPPER_CACHE.get(key)
+        if template is None:
+            template = _build_wrapper_template(test_cases, function_name)
+            _WRAPPER_CACHE[key] = template
+
+    return template.replace(_USER_CODE_SLOT, user_code, 1)
+
+
+_JOB_PREFIX_CACHE: Dict[Tuple[str, bool], str] = {}
+
+
+def build_job(user_code: str, test_cases: List[Dict[str, Any]],
+              function_name: str, challenge_id: Optional[str] = None,
+              include_tests: bool = True, progress: bool = False,
+              nonce: str = "") -> bytes:
+    if challenge_id is None:
+        include_tests = True
+        prefix = None
+    else:
+        prefix = _JOB_PREFIX_CACHE.get((challenge_id, include_tests))
+
+    if prefix is None:
+        prefix = f'{{"fn":{json.dumps(function_name)},"star":{json.dumps(uses_star_args(test_cases))},'
+        if challenge_id is not None:
+            prefix += f'"cid":{json.dumps(challenge_id)},'
+        if include_tests:
+            prefix += f'"tests":{json.dumps(test_cases, separators=(",", ":"))},'
+        prefix += '"code":'
+        if challenge_id is not None:
+            _JOB_PREFIX_CACHE[(challenge_id, include_tests)] = prefix
+
+    suffix = ',"progress":true' if progress else ''
+    return f'{prefix}{json.dumps(user_code)}{suffix},"nonce":{json.dumps(nonce)}}}\n'.encode()
+
+
+CPU_TIME_LIMIT = 2
+
+MEMORY_LIMIT_MB = 128
 
 
 def set_resource_limits():
     try:
-        resource.setrlimit(resource.RLIMIT_CPU, (2, 2))
-        resource.setrlimit(resource.RLIMIT_AS, (128 * 1024 * 1024, 128 * 1024 * 1024))
+        resource.setrlimit(resource.RLIMIT_CPU, (CPU_TIME_LIMIT, CPU_TIME_LIMIT + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY_LIMIT_MB * 1024 * 1024, MEMORY_LIMIT_MB * 1024 * 1024))
         resource.setrlimit(resource.RLIMIT_FSIZE, (10 * 1024 * 1024, 10 * 1024 * 1024))
         resource.setrlimit(resource.RLIMIT_NPROC, (1, 1))
     except Exception as e:
         print(f"Warning: Could not set resource limits: {e}", file=sys.stderr)
 
 
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", os.cpu_count() or 1))
+
+ACQUIRE_TIMEOUT = 30
+
+_WORKER_SCRIPT = str(Path(__file__).with_name("sandbox_worker.py"))
+
+
+class SandboxWorker:
+
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-P", _WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=tempfile.gettempdir(),
+            start_new_session=True,
+            env={
+                'PYTHONHASHSEED': '0',
+                'SANDBOX_CPU_TIME_LIMIT': str(CPU_TIME_LIMIT),
+                'SANDBOX_MEMORY_LIMIT_MB': str(MEMORY_LIMIT_MB),
+            }
+        )
+        self._buffer = bytearray()
+        self.challenges: set = set()
+
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def run(self, job: bytes, nonce: str, timeout: float,
+            on_progress: Optional[Callable[[dict], None]] = None) -> Tuple[str, str, Optional[dict]]:
+        self.proc.stdin.write(job)
+        self.proc.stdin.flush()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            reply = json.loads(self._read_line(deadline, timeout))
+            if reply.get("nonce") != nonce:
+                raise RuntimeError("Sandbox worker reply does not match the job")
+            if "progress" not in reply:
+                break
+            if on_progress is not None:
+                on_progress(reply["progress"])
+
+        if reply.get("timeout"):
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        return reply["stdout"], reply["stderr"], reply["result"]
+
+    def _read_line(self, deadline: float, timeout: float) -> bytes:
+        fd = self.proc.stdout.fileno()
+
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise subprocess.TimeoutExpired(self.proc.args, timeout)
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.proc.wait()
+                raise RuntimeError(f"Sandbox worker exited with code {self.proc.returncode}")
+            self._buffer += chunk
+
+        end = self._buffer.index(b"\n")
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        return line
+
+    def kill(self):
+        if self.is_alive():
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+
+
+class SandboxPool:
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: "queue.Queue[SandboxWorker]" = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _spawn(self) -> SandboxWorker:
+        try:
+            return SandboxWorker()
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+
+    def _acquire(self) -> SandboxWorker:
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                spawn = self._started < self.size
+                if spawn:
+                    self._started += 1
+            if spawn:
+                return self._spawn()
+            try:
+                worker = self._idle.get(timeout=ACQUIRE_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError("No sandbox worker became available") from None
+
+        if not worker.is_alive():
+            worker.kill()
+            worker = self._spawn()
+        return worker
+
+    def run(self, user_code: str, test_cases: List[Dict[str, Any]], function_name: str,
+            challenge_id: Optional[str], timeout: float,
+            on_progress: Optional[Callable[[dict], None]] = None) -> Tuple[str, str, Optional[dict]]:
+        worker = self._acquire()
+        try:
+            include_tests = challenge_id not in worker.challenges
+            nonce = secrets.token_hex(8)
+            job = build_job(user_code, test_cases, function_name, challenge_id, include_tests,
+                            progress=on_progress is not None, nonce=nonce)
+            reply = worker.run(job, nonce, timeout, on_progress)
+            if challenge_id is not None:
+                worker.challenges.add(challenge_id)
+            return reply
+        except BaseException:
+            worker.kill()
+            raise
+        finally:
+            self._idle.put(worker)
+
+
+_worker_pool = SandboxPool(SANDBOX_WORKERS) if SANDBOX_WORKERS > 0 else None
+
+_executor = ThreadPoolExecutor(max_workers=max(SANDBOX_WORKERS, 1), thread_name_prefix="sandbox")
+
+
+def _run_in_subprocess(test_script: str, timeout: float) -> Tuple[bytes, bytes]:
+    proc = subprocess.run(
+        [sys.executable, "-"],
+        input=test_script.encode(),
+        capture_output=True,
+        timeout=timeout,
+        cwd=tempfile.gettempdir(),
+        env={'PYTHONHASHSEED': '0'},
+        preexec_fn=set_resource_limits
+    )
+    if proc.returncode == -signal.SIGXCPU:
+        raise subprocess.TimeoutExpired(proc.args, timeout)
+    return proc.stdout, proc.stderr
+
+
 def execute_code(user_code: str, test_cases: List[Dict[str, Any]],
-                 function_name: str, timeout: int = 5) -> ExecutionResult:
+                 function_name: str, timeout: int = 5,
+                 challenge_id: Optional[str] = None,
+                 on_progress: Optional[Callable[[dict], None]] = None) -> ExecutionResult:
 
     is_safe, error_msg = check_forbidden_imports(user_code)
     if not is_safe:
@@ -137,53 +387,48 @@ def execute_code(user_code: str, test_cases: List[Dict[str, Any]],
             execution_time=0.0
         )
 
-    test_script = build_test_wrapper(user_code, test_cases, function_name)
-
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write(test_script)
-            temp_file = f.name
-
-        try:
-            proc = subprocess.run(
-                [sys.executable, temp_file],
-                capture_output=True,
-                timeout=timeout,
-                text=True,
-                cwd=tempfile.gettempdir(),
-                env={'PYTHONHASHSEED': '0'}
+        if _worker_pool is not None:
+            output, error, result_json = _worker_pool.run(
+                user_code, test_cases, function_name, challenge_id, timeout, on_progress
             )
-
-            output = proc.stdout.strip()
-            error = proc.stderr.strip()
+        else:
+            test_script = build_test_wrapper(user_code, test_cases, function_name, challenge_id)
+            stdout, stderr = _run_in_subprocess(test_script, timeout)
+            prints, _, last_line = stdout.rstrip().rpartition(b"\n")
 
             try:
-                result_json = json.loads(output)
-                return ExecutionResult(
-                    success=True,
-                    passed_tests=result_json.get('passed', 0),
-                    total_tests=result_json.get('total', len(test_cases)),
-                    test_results=result_json.get('test_results', []),
-                    output=output,
-                    error=error,
-                    execution_time=0.0
-                )
-            except json.JSONDecodeError:
-                return ExecutionResult(
-                    success=False,
-                    passed_tests=0,
-                    total_tests=len(test_cases),
-                    test_results=[],
-                    output=output,
-                    error=f"Invalid output format: {error}",
-                    execution_time=0.0
-                )
+                result_json = json.loads(last_line)
+            except ValueError:
+                result_json = None
+                prints = stdout
+
+            output = prints.decode(errors="replace")
+            error = stderr.decode(errors="replace")
+
+        output = output.strip()
+        error = error.strip()
+
+        if result_json is None:
+            return ExecutionResult(
+                success=False,
+                passed_tests=0,
+                total_tests=len(test_cases),
+                test_results=[],
+                output=output,
+                error=f"Invalid output format: {error}",
+                execution_time=0.0
+            )
 
-        finally:
-            try:
-                os.unlink(temp_file)
-            except:
-                pass
+        return ExecutionResult(
+            success=True,
+            passed_tests=result_json.get('passed', 0),
+            total_tests=result_json.get('total', len(test_cases)),
+            test_results=result_json.get('test_results', []),
+            output=output,
+            error=error,
+            execution_time=0.0
+        )
 
     except subprocess.TimeoutExpired:
         return ExecutionResult(
@@ -209,8 +454,22 @@ def execute_code(user_code: str, test_cases: List[Dict[str, Any]],
 
 
 def execute_safe_code(user_code: str, test_cases: List[Dict[str, Any]],
-                      function_name: str) -> ExecutionResult:
-    return execute_code(user_code, test_cases, function_name)
+                      function_name: str,
+                      challenge_id: Optional[str] = None) -> ExecutionResult:
+    return execute_code(user_code, test_cases, function_name, challenge_id=challenge_id)
+
+
+async def execute_code_async(user_code: str, test_cases: List[Dict[str, Any]],
+                             function_name: str, timeout: int = 5,
+                             challenge_id: Optional[str] = None,
+                             on_progress: Optional[Callable[[dict], None]] = None) -> ExecutionResult:
+    loop = asyncio.get_running_loop()
+    report = None
+    if on_progress is not None:
+        report = lambda entry: loop.call_soon_threadsafe(on_progress, entry)
+    return await loop.run_in_executor(
+        _executor, execute_code, user_code, test_cases, function_name, timeout, challenge_id, report
+    )
 
 
 if __name__ == "__main__":
@@ -1,19 +1,51 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 import socketio
 from contextlib import asynccontextmanager
 import asyncio
-from typing import Dict
+import inspect
+from functools import partial
+from typing import Dict, Set, Tuple
 from datetime import datetime
+import json
 import logging
+import os
 
-from challenges import get_challenge, CHALLENGES
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from challenges import get_challenge_dict, get_test_spec, get_all_challenges_json
 from matchmaking import matchmaking_system, BattleStatus
-from sandbox import execute_code
+from sandbox import execute_code_async
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class MsgspecJSON:
+    _encoder = msgspec.json.Encoder() if msgspec is not None else None
+
+    @classmethod
+    def dumps(cls, obj, **kwargs) -> str:
+        return cls._encoder.encode(obj).decode()
+
+    loads = staticmethod(json.loads)
+
+
+class MsgspecResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return MsgspecJSON._encoder.encode(content)
+
+
 sio = socketio.AsyncServer(
     async_mode='asgi',
     cors_allowed_origins=[],
@@ -21,16 +53,41 @@ sio = socketio.AsyncServer(
     ping_interval=25,
     logger=True,
     engineio_logger=True,
+    json=MsgspecJSON if msgspec is not None else None,
 )
 
 connected_users: Dict[str, dict] = {}
 socket_to_user: Dict[str, str] = {}
 
+SYNC_CODE_DEBOUNCE = 0.05
+pending_code_syncs: Dict[Tuple[str, str], dict] = {}
+background_tasks: Set[asyncio.Task] = set()
+
+ROOM_ARCHIVE_TTL = 600
+RECONNECT_GRACE = 10
+pending_forfeits: Dict[str, asyncio.Task] = {}
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = aioredis.from_url(REDIS_URL) if aioredis is not None and REDIS_URL else None
+
+CLOCK_RESOLUTION = 0.1
+current_timestamp = datetime.utcnow().isoformat()
+
+
+async def refresh_clock():
+    global current_timestamp
+    while True:
+        await asyncio.sleep(CLOCK_RESOLUTION)
+        current_timestamp = datetime.utcnow().isoformat()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Python-Duel server started")
+    clock_task = asyncio.create_task(refresh_clock())
     yield
+    clock_task.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
     logger.info("Python-Duel server shutting down")
 
 
@@ -38,7 +95,8 @@ app = FastAPI(
     title="Python-Duel",
     description="Real-time 1v1 competitive Python coding platform",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MsgspecResponse if msgspec is not None else JSONResponse,
 )
 
 # Add CORS middleware FIRST (middleware order matters - first added = last executed)
@@ -65,6 +123,9 @@ async def disconnect(sid):
     user_id = socket_to_user.get(sid)
     if user_id:
         matchmaking_system.remove_from_queue(user_id)
+        battle_room = matchmaking_system.get_player_battle_room(user_id)
+        if battle_room is not None and user_id not in pending_forfeits:
+            pending_forfeits[user_id] = asyncio.create_task(forfeit_after_grace(user_id, battle_room.room_id))
         if user_id in connected_users:
             del connected_users[user_id]
         del socket_to_user[sid]
@@ -81,13 +142,17 @@ async def register_user(sid, data):
             await sio.emit('error', {'message': 'Missing user_id or username'}, to=sid)
             return
 
+        if user_id in connected_users:
+            socket_to_user.pop(connected_users[user_id]['socket_id'], None)
+
         connected_users[user_id] = {
             'socket_id': sid,
             'username': username,
             'elo_rating': elo_rating,
-            'connected_at': datetime.utcnow().isoformat()
+            'connected_at': current_timestamp
         }
         socket_to_user[sid] = user_id
+        await rejoin_battle(user_id, sid)
 
         await sio.emit('user_registered', {
             'user_id': user_id,
@@ -117,7 +182,7 @@ async def join_queue(sid, data):
                 'socket_id': sid,
                 'username': username or 'Anonymous',
                 'elo_rating': elo_rating,
-                'connected_at': datetime.utcnow().isoformat()
+                'connected_at': current_timestamp
             }
             socket_to_user[sid] = user_id
             logger.info(f"Auto-registered user: {user_id} ({username})")
@@ -128,13 +193,14 @@ async def join_queue(sid, data):
             user_id=user_id,
             username=user_info['username'],
             elo_rating=user_info['elo_rating'],
-            socket_id=sid
+            socket_id=sid,
+            challenge_id=challenge_id
         )
 
         await sio.emit('queue_joined', {
             'user_id': user_id,
-            'queue_position': matchmaking_system.queue.index(player) + 1,
-            'queue_size': matchmaking_system.get_queue_size(),
+            'queue_position': matchmaking_system.get_queue_position(player.user_id),
+            'queue_size': matchmaking_system.get_queue_size(player.challenge_id),
             'message': 'Joined matchmaking queue'
         }, to=sid)
 
@@ -165,6 +231,12 @@ async def leave_queue(sid, data):
         await sio.emit('error', {'message': str(e)}, to=sid)
 
 
+async def enter_room(sid: str, room: str):
+    result = sio.enter_room(sid, room)
+    if inspect.isawaitable(result):
+        await result
+
+
 async def attempt_matchmaking(challenge_id: str):
     while matchmaking_system.get_queue_size() >= 2:
         battle_room = matchmaking_system.attempt_matchmaking(challenge_id)
@@ -174,36 +246,21 @@ async def attempt_matchmaking(challenge_id: str):
 
         matchmaking_system.start_battle(battle_room.room_id)
 
-        challenge = get_challenge(challenge_id)
+        p1 = battle_room.player1
+        p2 = battle_room.player2
 
-        room_data = {
+        await enter_room(p1.socket_id, battle_room.room_id)
+        await enter_room(p2.socket_id, battle_room.room_id)
+
+        await sio.emit('match_found', {
             'room_id': battle_room.room_id,
-            'opponent': None,
-            'challenge': {
-                'id': challenge.id,
-                'name': challenge.name,
-                'description': challenge.description,
-                'difficulty': challenge.difficulty,
-                'time_limit': challenge.time_limit,
-                'function_signature': challenge.function_signature,
-                'test_count': len(challenge.test_cases),
-            },
+            'players': [
+                {'socket_id': p.socket_id, 'username': p.username, 'elo_rating': p.elo_rating}
+                for p in (p1, p2)
+            ],
+            'challenge': get_challenge_dict(challenge_id),
             'message': 'Match found! Battle starting in 3 seconds...'
-        }
-
-        p1_data = room_data.copy()
-        p1_data['opponent'] = {
-            'username': battle_room.player2.username,
-            'elo_rating': battle_room.player2.elo_rating
-        }
-        await sio.emit('match_found', p1_data, to=battle_room.player1.socket_id)
-
-        p2_data = room_data.copy()
-        p2_data['opponent'] = {
-            'username': battle_room.player1.username,
-            'elo_rating': battle_room.player1.elo_rating
-        }
-        await sio.emit('match_found', p2_data, to=battle_room.player2.socket_id)
+        }, to=battle_room.room_id)
 
         logger.info(f"Match created: {battle_room.player1.username} vs {battle_room.player2.username} "
                    f"(Room: {battle_room.room_id})")
@@ -227,25 +284,17 @@ async def submit_code(sid, data):
 
         matchmaking_system.update_player_code(room_id, user_id, code)
 
-        challenge = get_challenge(battle_room.challenge_id)
-        if not challenge:
+        spec = get_test_spec(battle_room.challenge_id)
+        if spec is None:
             await sio.emit('error', {'message': 'Challenge not found'}, to=sid)
             return
+        func_name, test_cases = spec
 
-        test_cases = [
-            {
-                'input': tc.input_data if not isinstance(tc.input_data, tuple) else tc.input_data,
-                'expected': tc.expected_output
-            }
-            for tc in challenge.test_cases
-        ]
-
-        func_signature = challenge.function_signature
-        func_name = func_signature.split('(')[0].replace('def ', '').strip()
+        execution_result = await execute_code_async(code, test_cases, func_name, timeout=5,
+                                                    challenge_id=battle_room.challenge_id,
+                                                    on_progress=partial(emit_test_progress, room_id, user_id))
 
-        execution_result = execute_code(code, test_cases, func_name, timeout=5)
-
-        matchmaking_system.update_test_results(
+        recorded = matchmaking_system.update_test_results(
             room_id, user_id,
             execution_result.passed_tests,
             execution_result.total_tests
@@ -263,9 +312,7 @@ async def submit_code(sid, data):
 
         await sio.emit('code_submission', submission_result, to=room_id)
 
-        if execution_result.passed_tests == execution_result.total_tests:
-            battle_room = matchmaking_system.get_battle_room(room_id)
-
+        if recorded and execution_result.passed_tests == execution_result.total_tests:
             winner = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
             loser = battle_room.player2 if user_id == battle_room.player1.user_id else battle_room.player1
 
@@ -278,6 +325,7 @@ async def submit_code(sid, data):
 
             await sio.emit('battle_complete', winner_data, to=room_id)
             logger.info(f"Battle complete: {winner.username} won (Room: {room_id})")
+            await archive_battle_room(room_id)
 
         logger.info(f"Code submission: {user_id} - {execution_result.passed_tests}/{execution_result.total_tests} tests passed")
 
@@ -286,6 +334,78 @@ async def submit_code(sid, data):
         await sio.emit('error', {'message': str(e)}, to=sid)
 
 
+def emit_test_progress(room_id: str, user_id: str, entry: dict):
+    task = asyncio.create_task(sio.emit('test_progress', {
+        'test': entry.get('test'),
+        'status': entry.get('status'),
+        'passed_tests': entry.get('passed_tests'),
+        'user_id': user_id,
+        'room_id': room_id,
+    }, to=room_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def archive_battle_room(room_id: str):
+    battle_room = matchmaking_system.close_battle_room(room_id)
+    if battle_room is None or redis_client is None:
+        return
+
+    try:
+        await redis_client.setex(f"room:{room_id}", ROOM_ARCHIVE_TTL, json.dumps(battle_room.to_dict()))
+    except Exception as e:
+        logger.warning(f"Could not archive room {room_id}: {e}")
+
+
+async def forfeit_after_grace(user_id: str, room_id: str):
+    await asyncio.sleep(RECONNECT_GRACE)
+    del pending_forfeits[user_id]
+
+    battle_room = matchmaking_system.get_battle_room(room_id)
+    if battle_room is None:
+        return
+
+    leaver = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
+    opponent = battle_room.player2 if leaver is battle_room.player1 else battle_room.player1
+    winner = None
+    if opponent.user_id in connected_users:
+        winner = matchmaking_system.forfeit_battle(room_id, user_id)
+
+    if winner is not None:
+        await sio.emit('battle_complete', {
+            'winner_username': winner.username,
+            'loser_username': leaver.username,
+            'winner_id': winner.user_id,
+            'message': f'{leaver.username} left the battle. {winner.username} wins!'
+        }, to=room_id)
+        logger.info(f"Battle forfeited: {leaver.username} left (Room: {room_id})")
+    elif battle_room.winner_id is None:
+        battle_room.status = BattleStatus.ABANDONED
+    await archive_battle_room(room_id)
+
+
+async def rejoin_battle(user_id: str, sid: str):
+    forfeit = pending_forfeits.pop(user_id, None)
+    if forfeit is None:
+        return
+    forfeit.cancel()
+
+    battle_room = matchmaking_system.get_player_battle_room(user_id)
+    if battle_room is not None:
+        player = battle_room.player1 if user_id == battle_room.player1.user_id else battle_room.player2
+        player.socket_id = sid
+        await enter_room(sid, battle_room.room_id)
+        logger.info(f"User {user_id} rejoined room {battle_room.room_id}")
+
+
+async def flush_code_sync(key: Tuple[str, str]):
+    await asyncio.sleep(SYNC_CODE_DEBOUNCE)
+    payload = pending_code_syncs.pop(key, None)
+    if payload is not None:
+        room_id, sid = key
+        await sio.emit('opponent_code_update', payload, to=room_id, skip_sid=sid)
+
+
 @sio.event
 async def sync_code(sid, data):
     try:
@@ -299,10 +419,16 @@ async def sync_code(sid, data):
 
         matchmaking_system.update_player_code(room_id, user_id, code)
 
-        await sio.emit('opponent_code_update', {
+        key = (room_id, sid)
+        first_in_window = key not in pending_code_syncs
+        pending_code_syncs[key] = {
             'code': code,
             'user_id': user_id
-        }, to=room_id, skip_sid=sid)
+        }
+        if first_in_window:
+            task = asyncio.create_task(flush_code_sync(key))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
     except Exception as e:
         logger.error(f"Error in sync_code: {e}")
@@ -314,41 +440,22 @@ async def root():
         "status": "running",
         "service": "Python-Duel Backend",
         "version": "1.0.0",
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": current_timestamp
     }
 
 
 @app.get("/api/challenges")
 async def get_challenges():
-    challenges = []
-    for challenge_id, challenge in CHALLENGES.items():
-        challenges.append({
-            'id': challenge.id,
-            'name': challenge.name,
-            'description': challenge.description,
-            'difficulty': challenge.difficulty,
-            'time_limit': challenge.time_limit,
-            'test_count': len(challenge.test_cases),
-        })
-    return {"challenges": challenges}
+    return Response(content=get_all_challenges_json(), media_type="application/json")
 
 
 @app.get("/api/challenges/{challenge_id}")
 async def get_challenge_detail(challenge_id: str):
-    challenge = get_challenge(challenge_id)
-    if not challenge:
+    challenge = get_challenge_dict(challenge_id)
+    if challenge is None:
         raise HTTPException(status_code=404, detail="Challenge not found")
 
-    return {
-        'id': challenge.id,
-        'name': challenge.name,
-        'description': challenge.description,
-        'difficulty': challenge.difficulty,
-        'time_limit': challenge.time_limit,
-        'function_signature': challenge.function_signature,
-        'example_code': challenge.example_code,
-        'test_count': len(challenge.test_cases),
-    }
+    return challenge
 
 
 @app.get("/api/queue-info")
@@ -364,6 +471,21 @@ async def get_user_info(user_id: str):
     return connected_users[user_id]
 
 
+@app.get("/api/rooms/{room_id}")
+async def get_archived_room(room_id: str):
+    archived = None
+    if redis_client is not None:
+        try:
+            archived = await redis_client.get(f"room:{room_id}")
+        except Exception as e:
+            logger.warning(f"Could not read archived room {room_id}: {e}")
+            raise HTTPException(status_code=503, detail="Room archive unavailable")
+    if archived is None:
+        raise HTTPException(status_code=404, detail="Room not found or not archived")
+
+    return Response(content=archived, media_type="application/json")
+
+
 @app.get("/api/health")
 async def health_check():
     return {
@@ -371,7 +493,7 @@ async def health_check():
         "connected_users": len(connected_users),
         "queue_size": matchmaking_system.get_queue_size(),
         "active_battles": len(matchmaking_system.battle_rooms),
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": current_timestamp
     }
 
 